@@ -27,7 +27,8 @@ from keras.utils.np_utils import to_categorical
 from lag import LAG
 from llsr import LLSR as myLLSR
 from pixelhop2 import Pixelhop2
-from cross_entropy import Cross_Entropy
+from cross_entropy import Cross_Entropy, DFT
+from selection import select_top, take_columns
 get_ipython().magic('matplotlib inline')
 
 
@@ -36,6 +37,17 @@ get_ipython().magic('matplotlib inline')
 # In[ ]:
 
 
+#Data Type of the Whole Pipeline, from the Loaded Images to the Features of the Classifier
+dtype = 'float32'
+#Rank the Channels by the Best Split of the Discriminant Feature Test Instead of the Cross Entropy
+useDFT = False
+
+#Flag a Stage whose Outputs were Promoted Away from dtype
+def check_Dtype(stage, arrays):
+    for X in arrays:
+        if (X.dtype != dtype):
+            print("       <WARNING> %s returns %s instead of %s"%(stage, str(X.dtype), dtype))
+
 #Load File Function
 def load_file(fileName):
     data = open(fileName, 'rb')
@@ -49,7 +61,7 @@ def get_Batch(fileName):
     label = imageDict[b'labels']
     #Reshap Images
     data = data.reshape(10000,3,32,32)
-    data = data.transpose(0,2,3,1).astype("float")
+    data = data.transpose(0,2,3,1).astype(dtype)
     label = np.array(label)
     return data,label
 
@@ -65,8 +77,9 @@ def get_DataSet(rootPath):
     #Combine 6 Training Sets
     trainData = np.concatenate(trainX)
     trainLabel = np.concatenate(trainY)
-    #Do the Image Normalization
-    return trainData/255, trainLabel
+    #Do the Image Normalization in Place
+    trainData /= 255
+    return trainData, trainLabel
 
 #Get Test Sets
 def get_TestSet(rootPath):
@@ -78,8 +91,9 @@ def get_TestSet(rootPath):
     testY.append(label)  
     testData = np.concatenate(testX)
     testLabel = np.concatenate(testY)
-    #Do the Image Normalization
-    return testData/255, testLabel
+    #Do the Image Normalization in Place
+    testData /= 255
+    return testData, testLabel
 
 #Generate the n Dimension Random Sequences
 def gen_RandomSeque(dim, totalNum, sampleNum):
@@ -96,7 +110,8 @@ def get_FitSet(classNum, trainData, trainLabel):
     randNums = gen_RandomSeque(10,5000,classNum)
     #Fitting Data and Label
     fitLabel = []
-    fitData = np.zeros((totalNum,32,32,3))
+    fitIndex = []
+    fitData = np.zeros((totalNum,32,32,3), dtype=trainData.dtype)
     #Form a Random Sequence with 10k Images
     num = 0
     count = [0,0,0,0,0,0,0,0,0,0]
@@ -105,89 +120,39 @@ def get_FitSet(classNum, trainData, trainLabel):
         if(count[label] in randNums[label]):
             fitData[num] = trainData[i]
             fitLabel.append(label)
+            fitIndex.append(i)
             num = num + 1
         count[label] = count[label] + 1
     fitLabel = np.array(fitLabel)
-    return fitData, fitLabel
-
-#Transform the Data Image using Batch Method
-def PH_Transform(megaSize, batchSize, trainData, model):
-    previous = 0
+    #Index of Each Fitting Image in trainData
+    fitIndex = np.array(fitIndex)
+    return fitData, fitLabel, fitIndex
+
+#Transform the Data Images, Reusing the Features of the Images Transformed while Fitting
+def PH_Transform(model, trainData, trainIndex, fitFeatures, fitIndex, batchSize, pool):
+    #Position of Each Image in the Fit Set
+    pos = np.minimum(np.searchsorted(fitIndex, trainIndex), len(fitIndex) - 1)
+    shared = fitIndex[pos] == trainIndex
+    print("Images Shared with the Fit Set:", np.sum(shared))
+    #Features of All Images Allocated Once, Shared Rows Copied from the Fit Set, the Others Transformed in Place
     features = []
-    #Image Numbers Per Megabatch
-    totalNum = trainData.shape[0]
-    imageNum = int(totalNum / megaSize)
-    batchNum = int(totalNum / batchSize / megaSize) + 1
-    #Using Batching Method To Do the Transform
-    for j in range(megaSize):
-        feature = []
-        for i in range(1,batchNum):
-            trainBatch = trainData[previous:j*imageNum+i*batchSize]
-            featureBatch = model.transform(trainBatch)
-            previous = j * imageNum + i * batchSize
-            if(i == 1):
-                feature = featureBatch
-            else:
-                feature[0] = np.concatenate((feature[0],featureBatch[0]))
-                feature[1] = np.concatenate((feature[1],featureBatch[1]))
-                feature[2] = np.concatenate((feature[2],featureBatch[2]))
-        #print("Mega Batch No.", j)
-        features.append(feature)
-    print("Transform Done.")
-    #Max Pooling Operations
-    for i in range(megaSize):
-        features[i][0] = block_reduce(np.ascontiguousarray(features[i][0]), (1, 2, 2, 1), np.max)
-        features[i][1] = block_reduce(np.ascontiguousarray(features[i][1]), (1, 2, 2, 1), np.max)
-        features[i][2] = block_reduce(np.ascontiguousarray(features[i][2]), (1, 2, 2, 1), np.max)
-        #print('Max Pooled Mega Batch', i)
-    print("Max Pooling Done.")
+    for i in range(len(fitFeatures)):
+        fitFeature = fitFeatures[i].reshape(len(fitIndex), -1)
+        features.append(np.empty((len(trainData), fitFeature.shape[1]), dtype=model.dtype))
+        features[i][shared] = fitFeature[pos[shared]]
+    model.transform_batch(trainData, batch=batchSize, pool=pool, index=np.where(~shared)[0], out=features)
     return features
 
-#Merge the Mega Data Batch Together
-def merge_Features(features, megaNum):
-    #Merge into 5 Mega Batch 10k
-    feature_merge = []
-    batchNum = int(megaNum / 5)
-    for i in range(5):
-        feature_temp = []
-        for j in range(batchNum):
-            if(j==0):
-                feature_temp = features[i*batchNum+j]
-            else:
-                feature_temp[0] = np.concatenate((feature_temp[0],features[i*batchNum+j][0]))
-                feature_temp[1] = np.concatenate((feature_temp[1],features[i*batchNum+j][1]))
-                feature_temp[2] = np.concatenate((feature_temp[2],features[i*batchNum+j][2]))
-        #print("10K Images Merge Done")
-        feature_merge.append(feature_temp)
-    #Merge All Mega Batches 50k
-    feature_layer1 = np.concatenate((feature_merge[0][0],feature_merge[1][0], 
-                                          feature_merge[2][0],feature_merge[3][0],feature_merge[4][0]))
-    feature_layer2 = np.concatenate((feature_merge[0][1],feature_merge[1][1], 
-                                          feature_merge[2][1],feature_merge[3][1],feature_merge[4][1]))
-    feature_layer3 = np.concatenate((feature_merge[0][2],feature_merge[1][2], 
-                                          feature_merge[2][2],feature_merge[3][2],feature_merge[4][2]))
-    print("Features Merge Done")
-    #Features Reshape
-    dataNum = feature_layer1.shape[0]
-    feature_layer1 = feature_layer1.reshape(dataNum, -1)
-    feature_layer2 = feature_layer2.reshape(dataNum, -1)
-    feature_layer3 = feature_layer3.reshape(dataNum, -1)
-    print("Features Reshape Done")
-    #Print the Features Shape
-    print(feature_layer1.shape,feature_layer2.shape,feature_layer3.shape)
-    return feature_layer1, feature_layer2, feature_layer3
-
 #Cross Entropy Calculation for Single layer
 def cal_CE_layer(features, trainLabel):
-    kernelNum = features.shape[1]
-    #Compute the Cross_Entropy of Layer 1
-    CE = []
-    for i in range(kernelNum):
-        tempData = features[:,i]
-        tempData = tempData.reshape((len(tempData), -1))
-        ce = Cross_Entropy(num_class=10, num_bin=10)
-        ce_value = ce.KMeans_Cross_Entropy(tempData, trainLabel)
-        CE.append(ce_value)
+    if (useDFT == True):
+        #Lowest Weighted Class Entropy over 63 Quantile Splits of Each Channel, Lower is Better as for the CE
+        ce = DFT(num_class=10, num_bin=64, dtype=dtype)
+        CE = list(ce.score_parallel(features, trainLabel, method='compute'))
+        return CE
+    #Compute the KMeans Cross_Entropy of All Channels of the Layer on All Cores
+    ce = Cross_Entropy(num_class=10, num_bin=10, dtype=dtype)
+    CE = list(ce.score_parallel(features, trainLabel, method='KMeans_Cross_Entropy_1d'))
     return CE
 
 #Cross Entropy Calculation for Each Layer
@@ -198,15 +163,37 @@ def cal_CE(features1, features2, features3, trainLabel):
     print(len(CE1), len(CE2), len(CE3))
     return CE1, CE2, CE3
 
-#Select Features Indexes for Single CE Array
+#Cross Entropy of Each Layer Accumulated Chunk by Chunk while Transforming, without Keeping the Features of All Training Images
+#Pass 1: Range of Each Channel, Pass 2: Per-Class Bin Counts within the Range, the Chunk Outputs of Pass 1 are Held for Pass 2
+#up to hold Bytes so that Only the Other Chunks are Transformed Again; with fitFeatures the Ranges are Taken from the Fit Set
+#Instead (Values Outside Fall into the End Bins) and the Training Set is Transformed Once
+def PH_Stream_CE(model, trainData, trainLabel, batchSize, pool, chunk=5000, hold=2**30, fitFeatures=None):
+    ces = None
+    held = {}
+    if (fitFeatures is not None):
+        ces = [Cross_Entropy(num_class=10, num_bin=10, dtype=dtype).partial_range(f.reshape(len(f), -1)) for f in fitFeatures]
+    else:
+        for s in range(0, len(trainData), chunk):
+            features = model.transform_batch(trainData[s:s+chunk], batch=batchSize, pool=pool)
+            if ces is None:
+                ces = [Cross_Entropy(num_class=10, num_bin=10, dtype=dtype) for i in range(len(features))]
+            for i in range(len(features)):
+                ces[i].partial_range(features[i])
+            if (hold >= sum([f.nbytes for f in features])):
+                hold -= sum([f.nbytes for f in features])
+                held[s] = features
+    for s in range(0, len(trainData), chunk):
+        features = held.pop(s) if s in held else model.transform_batch(trainData[s:s+chunk], batch=batchSize, pool=pool)
+        for i in range(len(features)):
+            ces[i].partial_fit(features[i], trainLabel[s:s+chunk])
+    CE = [list(ce.finalize()) for ce in ces]
+    print(*[len(c) for c in CE])
+    return CE
+
+#Select Features Indexes for Single CE Array, the N Lowest CEs in Increasing Index Order
 def slct_Indexes_layer(CE, N):
-    num = len(CE)
-    index = range(num)
-    Z = sorted(zip(CE, index))
-    res, index = zip(*Z)
-    res = list(res[:N])
-    index = list(index[:N])
-    return res, index
+    index, res = select_top(CE, N)
+    return list(res), list(index)
 
 #Select Features Indexes Method ratio = alpha
 def slct_Indexes(CE1, CE2, CE3, N):
@@ -223,15 +210,22 @@ def slct_Indexes(CE1, CE2, CE3, N):
     slctdCE.append(slctdCE3)
     return slctdCE, indexes
 
-#Select Features for Single Layer
-def slct_Features_layer(features, indexes):
-    dataNum = features.shape[0]
-    featureNum = len(indexes)
-    slctdFeature = np.zeros(shape=(dataNum, featureNum))
-    #print(slctdFeature.shape)
-    for i in range(featureNum):
-        slctdFeature[:,i] = features[:, indexes[i]]
-    return slctdFeature
+#Select Features Indexes of Each Layer from Subsampled KMeans CEs, Refining Only the Channels Close to the Cutoff
+def rank_Indexes(features1, features2, features3, trainLabel, N):
+    indexes = []
+    slctdCE = []
+    ce = Cross_Entropy(num_class=10, num_bin=10, dtype=dtype)
+    for features in [features1, features2, features3]:
+        index, CE, err = ce.rank(features, trainLabel, N, method='KMeans_Cross_Entropy_1d')
+        print("Probability of a Different Selection:", err)
+        order = np.argsort(index)
+        indexes.append(list(index[order]))
+        slctdCE.append(list(CE[order]))
+    return slctdCE, indexes
+
+#Select Features for Single Layer, Gathered at Once into a New Array (or a .npy Memmap at Path memmap)
+def slct_Features_layer(features, indexes, memmap=None):
+    return take_columns(features, indexes, memmap=memmap)
 
 #Select Features based on Indexes List
 def slct_Features(features1, features2, features3, indexes):
@@ -246,12 +240,12 @@ def slct_Features(features1, features2, features3, indexes):
 
 #Features Clustering using LAG
 def LAG_Fit(slctd_Features_Train, trainLabel):
-    #lag1 = LAG(encode='distance', num_clusters=[12,12,12,12,12,12,12,12,12,12], alpha=10, learner=myLLSR(onehot=False))
-    #lag2 = LAG(encode='distance', num_clusters=[12,12,12,12,12,12,12,12,12,12], alpha=10, learner=myLLSR(onehot=False))
-    #lag3 = LAG(encode='distance', num_clusters=[12,12,12,12,12,12,12,12,12,12], alpha=10, learner=myLLSR(onehot=False))
-    lag1 = LAG(encode='distance', num_clusters=[5,5,5,5,5,5,5,5,5,5], alpha=10, learner=myLLSR(onehot=False))
-    lag2 = LAG(encode='distance', num_clusters=[5,5,5,5,5,5,5,5,5,5], alpha=10, learner=myLLSR(onehot=False))
-    lag3 = LAG(encode='distance', num_clusters=[5,5,5,5,5,5,5,5,5,5], alpha=10, learner=myLLSR(onehot=False))
+    #lag1 = LAG(encode='distance', num_clusters=[12,12,12,12,12,12,12,12,12,12], alpha=10, learner=myLLSR(onehot=False, dtype=dtype), dtype=dtype)
+    #lag2 = LAG(encode='distance', num_clusters=[12,12,12,12,12,12,12,12,12,12], alpha=10, learner=myLLSR(onehot=False, dtype=dtype), dtype=dtype)
+    #lag3 = LAG(encode='distance', num_clusters=[12,12,12,12,12,12,12,12,12,12], alpha=10, learner=myLLSR(onehot=False, dtype=dtype), dtype=dtype)
+    lag1 = LAG(encode='distance', num_clusters=[5,5,5,5,5,5,5,5,5,5], alpha=10, learner=myLLSR(onehot=False, dtype=dtype), dtype=dtype)
+    lag2 = LAG(encode='distance', num_clusters=[5,5,5,5,5,5,5,5,5,5], alpha=10, learner=myLLSR(onehot=False, dtype=dtype), dtype=dtype)
+    lag3 = LAG(encode='distance', num_clusters=[5,5,5,5,5,5,5,5,5,5], alpha=10, learner=myLLSR(onehot=False, dtype=dtype), dtype=dtype)
     #Extract Training Features
     slctd_Features_Train1 = slctd_Features_Train[0]
     slctd_Features_Train2 = slctd_Features_Train[1]
@@ -295,46 +289,44 @@ trainData, trainLabel = get_DataSet(dataPath)
 trainLabel_catgory = to_categorical(trainLabel)
 #Get the Testing Data
 testData, testLabel = get_TestSet(dataPath)
+check_Dtype("Loading", [trainData, testData])
 testLabel_category = to_categorical(testLabel)
 #Get the Fit
-fitData, fitLabel = get_FitSet(1000,trainData,trainLabel)
-trainData_4, trainLabel_4 = get_FitSet(1250,trainData,trainLabel)
-trainData_8, trainLabel_8 = get_FitSet(625,trainData,trainLabel)
-trainData_16, trainLabel_16 = get_FitSet(312,trainData,trainLabel)
-trainData_32, trainLabel_32 = get_FitSet(156,trainData,trainLabel)
+fitData, fitLabel, fitIndex = get_FitSet(1000,trainData,trainLabel)
+trainData_4, trainLabel_4, trainIndex_4 = get_FitSet(1250,trainData,trainLabel)
+trainData_8, trainLabel_8, trainIndex_8 = get_FitSet(625,trainData,trainLabel)
+trainData_16, trainLabel_16, trainIndex_16 = get_FitSet(312,trainData,trainLabel)
+trainData_32, trainLabel_32, trainIndex_32 = get_FitSet(156,trainData,trainLabel)
 #Choose the Portions
 data_portion = 1
 testNum = 10000
+#Images Transformed at a Time
+batchSize = 100
 if (data_portion == 1):
     dataNum = 50000
     trainDataSet = trainData
     trainLabelSet = trainLabel
-    megaSize = 25
-    batchSize = 100
+    trainIndexSet = np.arange(50000)
 if (data_portion == 4):
     dataNum = 12500
     trainDataSet = trainData_4
     trainLabelSet = trainLabel_4
-    megaSize = 25
-    batchSize = 100
+    trainIndexSet = trainIndex_4
 if (data_portion == 8):
     dataNum = 6250
     trainDataSet = trainData_8
     trainLabelSet = trainLabel_8
-    megaSize = 25
-    batchSize = 50
+    trainIndexSet = trainIndex_8
 if (data_portion == 16):
     dataNum = 3120
     trainDataSet = trainData_16
     trainLabelSet = trainLabel_16
-    megaSize = 20
-    batchSize = 78
+    trainIndexSet = trainIndex_16
 if (data_portion == 32):
     dataNum = 1560
     trainDataSet = trainData_32
     trainLabelSet = trainLabel_32
-    megaSize = 20
-    batchSize = 78
+    trainIndexSet = trainIndex_32
 
 
 # Define Shrink and Concat Arguments
@@ -342,14 +334,19 @@ if (data_portion == 32):
 # In[ ]:
 
 
+#Callback function applied to the images before collecting patches
+def Pool(X, shrinkArg):
+    num = shrinkArg['num']
+    if(num > 1):
+        X = block_reduce(X, (1, 2, 2, 1), np.max)
+    return X
+
 #Callback function for collecting patches and its inverse
 def Shrink(X, shrinkArg):
-    num = shrinkArg['num']
     win = shrinkArg['win']
     stride = shrinkArg['stride']
     channel = X.shape[-1]
-    if(num > 1):
-        X = block_reduce(X, (1, 2, 2, 1), np.max)
+    X = Pool(X, shrinkArg)
     X = view_as_windows(np.ascontiguousarray(X), (1,win,win,channel), (1,stride,stride,channel))
     X = X.reshape(X.shape[0], X.shape[1], X.shape[2], -1)
     return X
@@ -359,12 +356,12 @@ def Concat(X, concatArg):
     return X
 
 # set args
-SaabArgs = [{'num_AC_kernels':-1, 'needBias':False, 'useDC':True, 'batch':None, 'cw':False}, 
-            {'num_AC_kernels':-1, 'needBias':True, 'useDC':True, 'batch':None, 'cw':True},
-            {'num_AC_kernels':-1, 'needBias':True, 'useDC':True, 'batch':None, 'cw':True}]
-shrinkArgs = [{'func':Shrink, 'win':5, 'stride':1, 'num':1}, 
-              {'func':Shrink, 'win':5, 'stride':1, 'num':2},
-              {'func':Shrink, 'win':5, 'stride':1, 'num':3},]
+SaabArgs = [{'num_AC_kernels':-1, 'needBias':False, 'useDC':True, 'batch':1000, 'solver':'eigh', 'window_free':True, 'backend':'auto', 'cw':False}, 
+            {'num_AC_kernels':-1, 'needBias':True, 'useDC':True, 'batch':1000, 'solver':'eigh', 'window_free':True, 'backend':'auto', 'cw':True, 'cw_stack':True},
+            {'num_AC_kernels':-1, 'needBias':True, 'useDC':True, 'batch':1000, 'solver':'eigh', 'window_free':True, 'backend':'auto', 'cw':True, 'cw_stack':True}]
+shrinkArgs = [{'func':Shrink, 'pre':Pool, 'win':5, 'stride':1, 'num':1}, 
+              {'func':Shrink, 'pre':Pool, 'win':5, 'stride':1, 'num':2},
+              {'func':Shrink, 'pre':Pool, 'win':5, 'stride':1, 'num':3},]
 concatArg = {'func':Concat}
 
 
@@ -377,27 +374,48 @@ concatArg = {'func':Concat}
 trainStart = datetime.datetime.now()
 #PixelHop Fitting
 print("Training the Module 1 of PixelHop")
-model = Pixelhop2(depth=3, TH1=0.001, TH2=0.0001, SaabArgs=SaabArgs, shrinkArgs=shrinkArgs, concatArg=concatArg)
-model.fit(fitData)
-#Using Batching Method To Do the Transform
-print("Extracting Features of Training Data")
-features_train_raw = PH_Transform(megaSize, batchSize, trainDataSet, model)
-#Merge Training Image Features
-features_train_layer1, features_train_layer2, features_train_layer3 = merge_Features(features_train_raw, megaSize)
-#Feature Selection Process
-print("Selecting Features of Training Data")
-#Calculate the Cross Entrophy for Each Channel
-CE1, CE2, CE3 = cal_CE(features_train_layer1, features_train_layer2, features_train_layer3, trainLabelSet)
-#Select Feature Indexes based on CEs
-slctdCE, indexes = slct_Indexes(CE1, CE2, CE3, 1000)
-#Select Training Features based on Indexes List
-features_train_selected = slct_Features(features_train_layer1, features_train_layer2, features_train_layer3, indexes)
+model = Pixelhop2(depth=3, TH1=0.001, TH2=0.0001, SaabArgs=SaabArgs, shrinkArgs=shrinkArgs, concatArg=concatArg, dtype=dtype)
+features_fit = model.fit_transform(fitData, pool=2)
+#Streaming the Cross Entropy while Transforming, Only the Selected Features are Kept in Memory
+#Note this Switches the Selection from the KMeans CE of cal_CE to the Equal-Width Bin CE of Cross_Entropy.compute,
+#the Selected Features are Transformed Again by transform_selected
+streamCE = False
+if (streamCE == True):
+    del features_fit
+    print("Selecting Features of Training Data")
+    CE1, CE2, CE3 = PH_Stream_CE(model, trainDataSet, trainLabelSet, batchSize, pool=2)
+    slctdCE, indexes = slct_Indexes(CE1, CE2, CE3, 1000)
+    model.compile_selection(indexes, pool=2)
+    features_train_selected = model.transform_selected(trainDataSet, batch=batchSize)
+else:
+    #Using Batching Method To Do the Transform, the Fitting Images are not Transformed Again
+    print("Extracting Features of Training Data")
+    features_train_layer1, features_train_layer2, features_train_layer3 = PH_Transform(model, trainDataSet, trainIndexSet, features_fit, fitIndex, batchSize, pool=2)
+    del features_fit
+    check_Dtype("Pixelhop2", [features_train_layer1, features_train_layer2, features_train_layer3])
+    #Feature Selection Process
+    print("Selecting Features of Training Data")
+    #Ranking from Subsamples, Same Selection up to the Reported Error Probability
+    rankCE = False
+    if (rankCE == True):
+        slctdCE, indexes = rank_Indexes(features_train_layer1, features_train_layer2, features_train_layer3, trainLabelSet, 1000)
+    else:
+        #Calculate the Cross Entrophy for Each Channel
+        CE1, CE2, CE3 = cal_CE(features_train_layer1, features_train_layer2, features_train_layer3, trainLabelSet)
+        #Select Feature Indexes based on CEs
+        slctdCE, indexes = slct_Indexes(CE1, CE2, CE3, 1000)
+    #Select Training Features based on Indexes List
+    features_train_selected = slct_Features(features_train_layer1, features_train_layer2, features_train_layer3, indexes)
+check_Dtype("Feature Selection", features_train_selected)
 #Training Features LAG Fitting and Transform
 print("LAG Features of Training Data")
 features_Train_LAG, lag1, lag2, lag3 = LAG_Fit(features_train_selected, trainLabelSet)
+check_Dtype("LAG", [features_Train_LAG])
 #Train the SVM
 scaler = preprocessing.StandardScaler()
 features_Train_final = scaler.fit_transform(features_Train_LAG)
+check_Dtype("Scaler", [features_Train_final])
+#libsvm Makes its Own float64 Copy of the Features
 classifier = SVC().fit(features_Train_final, trainLabelSet)
 #Training Accuracy
 print('***** Train ACC:', accuracy_score(trainLabelSet, classifier.predict(features_Train_final)))
@@ -413,13 +431,13 @@ trainEnd = datetime.datetime.now()
 #Testing Time Starts
 testStart = datetime.datetime.now()
 print("Extracting Features of 10k Testing Data")
-features_test_raw = PH_Transform(25, 100, testData, model)
-#Merge 10K Testing Image Features
-features_test_layer1, features_test_layer2, features_test_layer3 = merge_Features(features_test_raw, 25)
-#Select Testing Features based on Indexes List
-features_test_selected = slct_Features(features_test_layer1, features_test_layer2, features_test_layer3, indexes)
+#Only Compute the Channels and Positions of the Selected Features
+model.compile_selection(indexes, pool=2)
+features_test_selected = model.transform_selected(testData, batch=batchSize)
+check_Dtype("Pixelhop2", features_test_selected)
 #Testing Features LAG Transform
 features_Test_LAG = LAG_Transform(features_test_selected, lag1, lag2, lag3)
+check_Dtype("LAG", [features_Test_LAG])
 #Tesing Classifier
 features_Test_final = scaler.transform(features_Test_LAG)
 #Testing Accuracy
@@ -428,6 +446,16 @@ print('***** Test ACC:', accuracy_score(testLabel, classifier.predict(features_T
 testEnd = datetime.datetime.now()
 #Number of Parameters Of SVM
 print(classifier.dual_coef_.shape)
+#Quantized Inference on the uint8 Images: int8 Kernels and Hop Outputs Calibrated on 1000 Fitting Images
+quantized = False
+if (quantized == True):
+    model.quantize(np.rint(fitData[:1000]*255).astype('uint8'), dtype='int8', scale=1/255)
+    model.compile_selection(indexes, pool=2)
+    features_test_quantized = model.transform_selected(np.rint(testData*255).astype('uint8'), batch=batchSize)
+    features_Test_quantized = scaler.transform(LAG_Transform(features_test_quantized, lag1, lag2, lag3))
+    testACC = accuracy_score(testLabel, classifier.predict(features_Test_final))
+    testACC_quantized = accuracy_score(testLabel, classifier.predict(features_Test_quantized))
+    print('***** Test ACC int8:', testACC_quantized, 'Delta:', testACC_quantized - testACC)
 
 
 # Times
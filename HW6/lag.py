@@ -1,12 +1,30 @@
 # 2020.04.06 v3
 # label assistant regression
 # modified from Yueru
+import os
 import numpy as np
-from sklearn.cluster import MiniBatchKMeans, KMeans
+from threadpoolctl import threadpool_limits
+from sklearn.cluster import MiniBatchKMeans, KMeans, kmeans_plusplus
 from sklearn.metrics.pairwise import euclidean_distances
+from parallel import pool_map
+
+def fit_class_(args):
+    # worker of LAG.compute_target_: clusters the samples X of one class, returns the labels and centroids
+    X, n_clusters, batch_size, subsample, threads = args
+    with threadpool_limits(limits=threads):
+        if subsample is not None:
+            # k-means++ seeds from a subsample, refined by mini-batches over all samples
+            sub = X[np.random.RandomState(9).choice(X.shape[0], min(subsample, X.shape[0]), replace=False)]
+            init, _ = kmeans_plusplus(sub, n_clusters, random_state=9)
+            kmeans = MiniBatchKMeans(n_clusters=n_clusters, init=init, n_init=1, batch_size=1024 if batch_size is None else batch_size, random_state=9).fit(X)
+        elif batch_size == None:
+            kmeans = KMeans(n_clusters=n_clusters, verbose=0, random_state=9).fit(X)
+        else:
+            kmeans = MiniBatchKMeans(n_clusters=n_clusters, verbose=0, batch_size=batch_size, n_init=5, random_state=9).fit(X)
+    return kmeans.labels_, kmeans.cluster_centers_
 
 class LAG():
-    def __init__(self, learner, encode='onehot', num_clusters=[10,10], alpha=5, par={}):
+    def __init__(self, learner, encode='onehot', num_clusters=[10,10], alpha=5, par={}, dtype='float32'):
         assert (str(learner.__class__) == "<class 'llsr.LLSR'>"), "Currently only support <class 'llsr.LLSR'>!"
         self.learner = learner
         self.encode = encode 
@@ -15,51 +33,62 @@ class LAG():
         self.clus_labels = []
         self.centroid = []
         self.num_class = []
+        self.dtype = dtype
         self.trained = False
         
-    def compute_target_(self, X, Y, batch_size): 
+    def compute_target_(self, X, Y, batch_size, n_jobs=None, subsample=None, start_method=None): 
+        # the classes are clustered concurrently by a pool of n_jobs processes (default: all cores, at most
+        # one per class, started as in parallel.pool_map), every process with its share of the BLAS / OpenMP threads
         Y = Y.reshape(-1)
         class_list = np.unique(Y)
         labels = np.zeros((X.shape[0]))
         self.clus_labels = np.zeros((np.sum(self.num_clusters),))
-        self.centroid = np.zeros((np.sum(self.num_clusters), X.shape[1]))
+        self.centroid = np.zeros((np.sum(self.num_clusters), X.shape[1]), dtype=self.dtype)
+        n_jobs = min(os.cpu_count() if n_jobs is None else n_jobs, len(class_list))
+        threads = max(1, os.cpu_count() // n_jobs)
+        tasks = [(X[Y==class_list[i]], self.num_clusters[i], batch_size, subsample, threads) for i in range(len(class_list))]
+        res = pool_map(fit_class_, tasks, n_jobs, start_method=start_method)
         start = 0
         for i in range(len(class_list)):
             ID = class_list[i]
-            feature_train = X[Y==ID]
-            if batch_size == None:
-                kmeans = KMeans(n_clusters=self.num_clusters[i], verbose=0, random_state=9, n_jobs=10).fit(feature_train)
-            else:
-                kmeans = MiniBatchKMeans(n_clusters=self.num_clusters[i], verbose=0, batch_size=batch_size, n_init=5).fit(feature_train)
-            labels[Y==ID] = kmeans.labels_ + start
+            labels[Y==ID] = res[i][0] + start
             self.clus_labels[start:start+self.num_clusters[i]] = ID
-            self.centroid[start:start+self.num_clusters[i]] = kmeans.cluster_centers_
+            self.centroid[start:start+self.num_clusters[i]] = res[i][1]
             start += self.num_clusters[i]
         return labels.astype('int32')
 
-    def fit(self, X, Y, batch_size=None):
+    def fit(self, X, Y, batch_size=None, n_jobs=None, subsample=None, start_method=None):
         '''
         LAG unit: fit
         input: X of shape (N, K), N is the number of training samples
+        the per-class clusterings run on n_jobs processes, with subsample they are seeded by
+        k-means++ on that many samples of the class and refined by mini-batches
         '''
+        X = X.astype(self.dtype, copy=False)
         self.num_class = len(np.unique(Y))
         assert (len(self.num_clusters) >= self.num_class), "'len(num_cluster)' must larger than class number!"
-        Yt = self.compute_target_(X, Y, batch_size=batch_size)    
+        Yt = self.compute_target_(X, Y, batch_size=batch_size, n_jobs=n_jobs, subsample=subsample, start_method=start_method)    
         if self.encode == 'distance': # this is the mode used in the paper
-            Yt_onehot = np.zeros((Yt.shape[0], self.clus_labels.shape[0]))
-            for i in range(Yt.shape[0]):
-                gt = Y[i].copy()
-                dis = euclidean_distances(X[i].reshape(1,-1), self.centroid[self.clus_labels == gt]).reshape(-1)
-                dis = dis / (np.min(dis) + 1e-15)
+            Yt_onehot = np.zeros((Yt.shape[0], self.clus_labels.shape[0]), dtype=self.dtype)
+            Y = Y.reshape(-1)
+            # the samples of a class against the centroids of that class at once, the other entries stay 0
+            for gt in np.unique(Y):
+                idx, col = np.where(Y == gt)[0], np.where(self.clus_labels == gt)[0]
+                dis = euclidean_distances(X[idx], self.centroid[col])
+                dis = dis / (np.min(dis, axis=1, keepdims=True) + 1e-15)
                 p_dis = np.exp(-dis * self.alpha)
-                p_dis = p_dis / np.sum(p_dis)
-                Yt_onehot[i, self.clus_labels == gt] = p_dis            
+                p_dis = p_dis / np.sum(p_dis, axis=1, keepdims=True)
+                Yt_onehot[idx[:, None], col] = p_dis
         elif self.encode == 'onehot':
-            Yt_onehot = np.eye(len(np.unique(Yt)))[Yt.reshape(-1)]
+            Yt_onehot = np.eye(len(np.unique(Yt)), dtype=self.dtype)[Yt.reshape(-1)]
         else:
             print("       <Warning>        Using raw label for learner.")
             Yt_onehot = Yt
         self.learner.fit(X, Yt_onehot)
+        # fused inference: the LLSR weight and bias, and the one-hot cluster -> class aggregation folded into them
+        self.Weight, self.Bias = self.learner.weight[:-1], self.learner.weight[-1]
+        self.Agg = np.eye(self.num_class, dtype=self.Weight.dtype)[self.clus_labels.astype('int64')]
+        self.ClassWeight, self.ClassBias = np.matmul(self.Weight, self.Agg), np.matmul(self.Bias, self.Agg)
         self.trained = True
         
     def transform(self, X):
@@ -70,7 +99,11 @@ class LAG():
         Example: if having 10 classes, and create 5 seeds per class, output size = (N,50)
         '''
         assert (self.trained == True), "Must call fit first!"
-        return self.learner.predict_proba(X)
+        if self.learner.normalize == True:
+            return self.learner.predict_proba(X.astype(self.dtype, copy=False))
+        res = np.matmul(X.astype(self.dtype, copy=False), self.Weight)
+        res += self.Bias
+        return res
     
     def predict_proba(self, X):
         '''
@@ -80,11 +113,13 @@ class LAG():
         Example: if having 10 classes, output size = (N,10)
         '''
         assert (self.trained == True), "Must call fit first!"
-        X = self.transform(X)
-        pred_labels = np.zeros((X.shape[0], self.num_class))
-        for km_i in range(self.num_class):
-            pred_labels[:, km_i] = np.sum(X[:, self.clus_labels==km_i], axis=1)
-        pred_labels = pred_labels/np.sum(pred_labels,axis=1,keepdims=1)
+        # the normalized LLSR output is not linear, its clusters are summed per class after the fact
+        if self.learner.normalize == True:
+            pred_labels = np.matmul(self.transform(X), self.Agg)
+        else:
+            pred_labels = np.matmul(X.astype(self.dtype, copy=False), self.ClassWeight)
+            pred_labels += self.ClassBias
+        pred_labels /= np.sum(pred_labels, axis=1, keepdims=True)
         return pred_labels   
 
     def predict(self, X):
@@ -119,4 +154,21 @@ if __name__ == "__main__":
     X_train_predprob = lag.predict_proba(X_train)
     print(" --> train acc: %s"%str(lag.score(X_train, y_train)))
     print(" --> test acc.: %s"%str(lag.score(X_test, y_test)))
+    # fused class probabilities, same as summing the clusters of every class of the transform
+    X_test_trans = lag.transform(X_test)
+    ref = np.stack([np.sum(X_test_trans[:, lag.clus_labels==k], axis=1) for k in range(10)], axis=1)
+    assert (np.allclose(lag.predict_proba(X_test), ref / np.sum(ref, axis=1, keepdims=True), atol=1e-4)), "predict_proba error!"
+    # the classes clustered by a pool of processes, same as one after the other
+    lag2 = LAG(encode='distance', num_clusters=[2,2,2,2,2,2,2,2,2,2], alpha=5, learner=myLLSR(onehot=False))
+    lag2.fit(X_train, y_train, n_jobs=2)
+    assert (np.allclose(lag2.centroid, lag.centroid) and np.allclose(lag2.transform(X_test), lag.transform(X_test))), "n_jobs error!"
+    # mini-batch k-means, seeded too
+    lag2.fit(X_train, y_train, n_jobs=1, batch_size=64)
+    lag3 = LAG(encode='distance', num_clusters=[2,2,2,2,2,2,2,2,2,2], alpha=5, learner=myLLSR(onehot=False))
+    lag3.fit(X_train, y_train, n_jobs=2, batch_size=64)
+    assert (np.allclose(lag2.centroid, lag3.centroid)), "batch_size n_jobs error!"
+    # k-means++ on a subsample and mini-batch refinement
+    lag2 = LAG(encode='distance', num_clusters=[2,2,2,2,2,2,2,2,2,2], alpha=5, learner=myLLSR(onehot=False))
+    lag2.fit(X_train, y_train, n_jobs=2, subsample=50, batch_size=64)
+    print(" --> subsample test acc.: %s"%str(lag2.score(X_test, y_test)))
     print("------- DONE -------\n")
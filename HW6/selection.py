@@ -0,0 +1,57 @@
+# 2020.04.25
+# top N feature selection by CE
+#
+#   select_top: indexes of the N lowest CE, in increasing index order
+#   take_columns: the selected columns of a feature set, gathered at once into a preallocated (or memmapped) array
+#
+# the index plan of select_top is applied to the train features with take_columns
+# and to the test images with Pixelhop2.compile_selection
+import numpy as np
+
+def select_top(CE, N):
+    # same set as a stable sort of CE (ties at the cutoff go to the lowest indexes),
+    # indexes sorted so that the columns are read in memory order
+    CE = np.asarray(CE)
+    if N <= 0:
+        return np.empty(0, dtype=np.intp), CE[:0]
+    if N >= CE.shape[0]:
+        index = np.arange(CE.shape[0])
+        return index, CE[index]
+    index = np.argpartition(CE, N - 1)[:N]
+    t = np.max(CE[index])
+    below = index[CE[index] < t]
+    index = np.concatenate((below, np.flatnonzero(CE == t)[:N - below.shape[0]]))
+    index.sort()
+    return index, CE[index]
+
+def take_columns(X, index, out=None, memmap=None):
+    # X[:, index] in X's dtype with a single np.take, into out, a new .npy memmap at path memmap or a new array
+    shape = (X.shape[0], len(index))
+    if out is None and memmap is not None:
+        out = np.lib.format.open_memmap(memmap, mode='w+', dtype=X.dtype, shape=shape)
+    elif out is None:
+        out = np.empty(shape, dtype=X.dtype)
+    assert (out.shape == shape and out.dtype == X.dtype), "out has to be a (%d, %d) %s array!"%(shape[0], shape[1], str(X.dtype))
+    np.take(X, index, axis=1, out=out)
+    return out
+
+if __name__ == "__main__":
+    print(" > This is a test example: ")
+    CE = np.random.RandomState(0).randint(0, 50, 1000).astype('float64')
+    X = np.random.RandomState(1).randn(200, 1000).astype('float32')
+    # same set as sorting (CE, index) pairs
+    ref = sorted(zip(CE, range(CE.shape[0])))[:100]
+    index, res = select_top(CE, 100)
+    assert (np.array_equal(index, np.sort([i for c, i in ref]))), "select_top error!"
+    assert (np.array_equal(res, CE[index])), "select_top error!"
+    index0, res0 = select_top(CE, 0)
+    assert (index0.shape == (0,) and res0.shape == (0,)), "select_top N=0 error!"
+    # same columns as one at a time
+    feature = take_columns(X, index)
+    assert (feature.dtype == X.dtype and np.array_equal(feature, X[:, index])), "take_columns error!"
+    import tempfile, os
+    path = os.path.join(tempfile.mkdtemp(), 'selected.npy')
+    feature = take_columns(X, index, memmap=path)
+    feature.flush()
+    assert (np.array_equal(np.load(path), X[:, index])), "take_columns memmap error!"
+    print("------- DONE -------\n")
@@ -7,30 +7,106 @@
 #   compute:
 #         Manimaran A, Ramanathan T, You S, et al. Visualization, Discriminability and Applications of Interpretable Saak Features[J]. 2019.
 #   KMeans_Cross_Entropy
+#
+# class DFT()
+#   Discriminant feature test, the weighted class entropy of the best 1-D split of each feature
+#
+# score_parallel runs any of them on the columns of a feature matrix in a process pool
+# rank selects the N features of lowest CE from subsamples, refining only the features close to the cutoff
 
+import os
 import numpy as np 
 import math
 import sklearn
+from multiprocessing import shared_memory
 from sklearn.cluster import KMeans,MiniBatchKMeans
+from parallel import pool_map
+
+def score_columns_(ce, X, Y, method):
+    # CE of every column of X by ce.method
+    if method == 'KMeans_Cross_Entropy':
+        res = [ce.KMeans_Cross_Entropy(X[:, k:k+1], Y) for k in range(X.shape[1])]
+    else:
+        res = getattr(ce, method)(X, Y)
+    return np.array(res, dtype='float64').reshape(-1)
+
+def score_shard_(args):
+    # worker of Cross_Entropy.score_parallel: scores the columns [a, b) of the shared feature matrix
+    name, shape, dtype, Y, a, b, cls, par, method = args
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        X = np.ndarray(shape, dtype=dtype, buffer=shm.buf, order='F')[:, a:b]
+        res = score_columns_(cls(**par), X, Y, method)
+        # the buffer cannot be closed while a view of it is alive
+        del X
+    finally:
+        shm.close()
+    return a, res
+
+def score_parallel_(ce, X, Y, method, n_jobs=None, start_method=None):
+    # ce.method of every column of X (N, F) in column order, the columns are sharded across a pool of
+    # n_jobs processes (default: all cores) which read X from shared memory, copied once in column-major
+    # order; with a single job X is scored in place, without the shared copy
+    # start_method of the pool as in parallel.pool_map
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    if n_jobs == 1:
+        return score_columns_(ce, X, Y, method)
+    N, F = X.shape
+    bound = np.linspace(0, F, min(F, 4 * n_jobs) + 1).astype('int64')
+    par = {'num_class': ce.num_class, 'num_bin': ce.num_bin, 'dtype': ce.dtype}
+    shm = shared_memory.SharedMemory(create=True, size=max(1, N * F * np.dtype(ce.dtype).itemsize))
+    try:
+        shared = np.ndarray((N, F), dtype=ce.dtype, buffer=shm.buf, order='F')
+        shared[:] = X
+        del shared
+        tasks = [(shm.name, (N, F), ce.dtype, Y, a, b, type(ce), par, method) for a, b in zip(bound[:-1], bound[1:]) if b > a]
+        res = pool_map(score_shard_, tasks, n_jobs, start_method=start_method)
+    finally:
+        shm.close()
+        shm.unlink()
+    res_ = np.zeros(F)
+    for a, r in res:
+        res_[a:a+len(r)] = r
+    return res_
 
 class Cross_Entropy():
-    def __init__(self, num_class, num_bin=10):
+    def __init__(self, num_class, num_bin=10, dtype='float32'):
         self.num_class = (int)(num_class)
         self.num_bin = (int)(num_bin)
+        self.dtype = dtype
+        # state of the streaming compute: bin edges, (F, num_bin, num_class) counts and class sizes
+        self.low, self.high, self.count, self.size = None, None, None, None
+
+    def bin_count_(self, x, y, mn, mx):
+        # per-class sample counts of the equal-width bins between mn and mx of every feature, (F, num_bin, num_class),
+        # values out of [mn, mx] fall into the end bins
+        F = x.shape[1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = ((x - mn) / (mx - mn)) * (self.num_bin)
+        b = np.where(mx == mn, 0, x).astype('int64')
+        np.clip(b, 0, self.num_bin - 1, out=b)
+        # 2-D bincount over (feature, bin, class)
+        b += np.arange(F) * self.num_bin
+        b *= self.num_class
+        b += y.reshape(-1, 1)
+        return np.bincount(b.reshape(-1), minlength=F * self.num_bin * self.num_class).reshape(F, self.num_bin, self.num_class)
+
+    def majority_(self, count, size, const):
+        # majority class of every bin, class counts normalized by the class sizes, -1 for constant features
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mybin = np.argmax(count / size.astype('float64'), axis=2)
+        mybin[const] = -1
+        return mybin
 
     def bin_process(self, x ,y):
-        if np.max(x) ==  np.min(x):
-            return -1*np.ones(self.num_bin)
-        x = ((x - np.min(x)) / (np.max(x) - np.min(x))) * (self.num_bin)
-        mybin = np.zeros((self.num_bin, self.num_class))
-        b = x.astype('int64')
-        b[b == self.num_bin] -= 1
-        for i in range(b.shape[0]):
-            mybin[b[i], y[i]] += 1.
-        for l in range(0, self.num_class):
-            p = np.array(y[ y==l ]).shape[0]
-            mybin[:, l] /= (float)(p)
-        return np.argmax(mybin, axis=1)
+        # majority class (class counts normalized by the class sizes) of every equal-width bin,
+        # x: (N,) or (N, F) for all features at once, -1 for constant features
+        ndim, F = x.ndim, 1 if x.ndim == 1 else x.shape[1]
+        x = x.reshape(x.shape[0], F)
+        mn, mx = np.min(x, axis=0), np.max(x, axis=0)
+        count = self.bin_count_(x, y, mn, mx)
+        mybin = self.majority_(count, np.bincount(y.reshape(-1), minlength=self.num_class), mx == mn)
+        return mybin[0] if ndim == 1 else mybin
     
     def kmeans_process(self, x, y):
         kmeans = KMeans(n_clusters=self.num_bin, random_state=0).fit(x.reshape(1,-1))
@@ -45,41 +121,80 @@ class Cross_Entropy():
         return np.argmax(mybin, axis=1)
 
     def compute_prob(self, x, y):
+        # fraction of the bins of every feature won by each class, (num_class, F),
+        # features are binned a chunk at a time so that the (N, chunk) bin indexes stay small
         prob = np.zeros((self.num_class, x.shape[1]))
-        for k in range(0, x.shape[1]):
-            mybin = self.bin_process(x[:,k], y[:,0])
+        chunk = max(1, 2**22 // x.shape[0])
+        for k in range(0, x.shape[1], chunk):
+            mybin = self.bin_process(x[:, k:k+chunk], y[:,0])
             #mybin = self.kmeans_process(x[:,k], y[:,0])
-            for l in range(0, self.num_class):
-                p = mybin[mybin == l]
-                p = np.array(p).shape[0]
-                prob[l, k] = p / (float)(self.num_bin)
+            prob[:, k:k+chunk] = self.won_(mybin)
         return prob
 
+    def won_(self, mybin):
+        # fraction of the bins won by each class, (num_class, F), bins of constant features (-1) are won by no class
+        won = np.where(mybin >= 0, mybin + np.arange(mybin.shape[0]).reshape(-1, 1) * self.num_class, -1)
+        count = np.bincount(won[won >= 0], minlength=mybin.shape[0] * self.num_class).reshape(-1, self.num_class)
+        return np.transpose(count) / (float)(self.num_bin)
+
     def compute(self, x, y, class_weight=None):
-        x = x.astype('float64')
+        x = x.astype(self.dtype, copy=False)
         y = y.astype('int64')
         y = y.reshape(-1, 1)
         prob = self.compute_prob(x, y)
+        return self.entropy_(prob, np.bincount(y[:, 0], minlength=self.num_class)[:self.num_class], class_weight)
+
+    def entropy_(self, prob, size, class_weight=None):
         prob = -1 * np.log10(prob + 1e-5) / np.log10(self.num_class)
-        y = np.moveaxis(y, 0, 1)
-        H = np.zeros((self.num_class, x.shape[1]))
-        for c in range(0, self.num_class):
-            yy = y == c
-            p = prob[c].reshape(prob.shape[1], 1)
-            p = p.repeat(yy.shape[1], axis=1)
-            H[c] += np.mean(yy * p, axis=1)
-        if class_weight != None:
+        # mean over the samples of prob[y], one term per class weighted by its frequency
+        freq = size / (float)(np.sum(size))
+        H = prob * freq.reshape(-1, 1)
+        if class_weight is not None:
             class_weight = np.array(class_weight)
             H *= class_weight.reshape(class_weight.shape[0],1) * self.num_class
         return np.mean(H, axis=0)
 
+    def partial_range(self, x):
+        # streaming compute, pass 1: running min / max of every feature over the batches x (n, F),
+        # a pass over a subset only gives a sketch of the edges
+        x = x.astype(self.dtype, copy=False)
+        mn, mx = np.min(x, axis=0), np.max(x, axis=0)
+        if self.low is None:
+            self.low, self.high = mn, mx
+        else:
+            np.minimum(self.low, mn, out=self.low)
+            np.maximum(self.high, mx, out=self.high)
+        self.count, self.size = None, None
+        return self
+
+    def partial_fit(self, x, y):
+        # streaming compute, pass 2: accumulate the per-class bin counts of the batch x (n, F) with the fixed edges
+        assert (self.low is not None), "Call partial_range on the features first!"
+        x = x.astype(self.dtype, copy=False)
+        y = y.astype('int64').reshape(-1)
+        if self.count is None:
+            self.count = np.zeros((x.shape[1], self.num_bin, self.num_class), dtype='int64')
+            self.size = np.zeros((self.num_class), dtype='int64')
+        chunk = max(1, 2**22 // x.shape[0])
+        for k in range(0, x.shape[1], chunk):
+            self.count[k:k+chunk] += self.bin_count_(x[:, k:k+chunk], y, self.low[k:k+chunk], self.high[k:k+chunk])
+        self.size += np.bincount(y, minlength=self.num_class)[:self.num_class]
+        return self
+
+    def finalize(self, class_weight=None):
+        # CE of every feature from the accumulated counts, same as compute on all the batches
+        # when the edges come from a full partial_range pass
+        assert (self.count is not None), "Call partial_fit on the features first!"
+        mybin = self.majority_(self.count, self.size, self.high == self.low)
+        return self.entropy_(self.won_(mybin), self.size, class_weight)
+
     # new cross entropy
     def KMeans_Cross_Entropy(self, X, Y):
         if np.unique(Y).shape[0] == 1: #alread pure
             return 0
         if X.shape[0] < self.num_bin:
             return -1
-        kmeans = MiniBatchKMeans(n_clusters=self.num_bin, random_state=0, batch_size=10000).fit(X)
+        kmeans = MiniBatchKMeans(n_clusters=self.num_bin, random_state=0, batch_size=10000).fit(X.astype(self.dtype, copy=False))
         prob = np.zeros((self.num_bin, self.num_class))
         for i in range(self.num_bin):
             idx = (kmeans.labels_ == i)
@@ -91,8 +206,167 @@ class Cross_Entropy():
         probab = prob[kmeans.labels_]
         return sklearn.metrics.log_loss(y, probab)/math.log(self.num_class)
 
+    def KMeans_Cross_Entropy_1d(self, X, Y, max_iter=100):
+        # KMeans_Cross_Entropy of every column of X (N, F) in one call, deterministic: 1-D k-means on the
+        # sorted columns, started from the quantiles, Lloyd iterations on prefix sums for all columns at once
+        Y = Y.reshape(-1).astype('int64')
+        N, F = X.shape
+        if np.unique(Y).shape[0] == 1: #alread pure
+            return np.zeros(F)
+        if N < self.num_bin:
+            return -1 * np.ones(F)
+        k, C = self.num_bin, self.num_class
+        size = np.bincount(Y, minlength=C)[:C]
+        eps = np.finfo('float64').eps
+        ce = np.zeros(F)
+        chunk = max(1, 2**22 // N)
+        for s in range(0, F, chunk):
+            x = X[:, s:s+chunk].astype('float64')
+            f, col = x.shape[1], np.arange(x.shape[1])
+            order = np.argsort(x, axis=0, kind='stable')
+            x = np.take_along_axis(x, order, axis=0)
+            csum = np.concatenate((np.zeros((1, f)), np.cumsum(x, axis=0)), axis=0)
+            # columns mapped to disjoint increasing ranges, one searchsorted finds the boundaries of all of them
+            mn, rng = x[0], x[-1] - x[0]
+            rng[rng == 0] = 1
+            key = np.transpose((x - mn) / rng + 2 * col).reshape(-1)
+            center = x[((np.arange(k) + 0.5) * N / k).astype('int64')]
+            bound = None
+            for it in range(max_iter):
+                mid = ((center[1:] + center[:-1]) / 2 - mn) / rng + 2 * col
+                pos = np.searchsorted(key, np.transpose(mid).reshape(-1)).reshape(f, k-1) - col.reshape(-1, 1) * N
+                if bound is not None and np.array_equal(pos, bound):
+                    break
+                bound = pos
+                edge = np.concatenate((np.zeros((1, f), dtype='int64'), np.transpose(pos), np.full((1, f), N)), axis=0)
+                num = np.diff(edge, axis=0)
+                total = np.diff(np.take_along_axis(csum, edge, axis=0), axis=0)
+                # empty clusters keep their center
+                center = np.sort(np.where(num > 0, total / np.maximum(num, 1), center), axis=0)
+            # cluster of every sorted sample: number of boundaries at or before it
+            label = np.zeros((N + 1, f), dtype='int64')
+            np.add.at(label, (np.transpose(bound), col), 1)
+            label = np.cumsum(label[:N], axis=0)
+            label += col * k
+            label *= C
+            label += Y[order]
+            count = np.bincount(label.reshape(-1), minlength=f * k * C).reshape(f, k, C)
+            prob = count / (size + 1e-5)
+            prob = prob / (np.sum(prob, axis=2, keepdims=True) + 1e-5)
+            # log_loss of the one-hot labels, clipped like sklearn
+            ce[s:s+chunk] = -np.sum(count * np.log(np.clip(prob, eps, 1 - eps)), axis=(1, 2)) / N / math.log(C)
+        return ce
+
+    def score_parallel(self, X, Y, method='compute', n_jobs=None, start_method=None):
+        # CE of every column of X (N, F) in column order, by 'method' ('compute', 'KMeans_Cross_Entropy_1d'
+        # or 'KMeans_Cross_Entropy'), see score_parallel_
+        assert (method in ['compute', 'KMeans_Cross_Entropy_1d', 'KMeans_Cross_Entropy']), "Unknown 'method'!"
+        return score_parallel_(self, X, Y, method, n_jobs, start_method)
+
+    def rank(self, X, Y, N, method='KMeans_Cross_Entropy_1d', frac=0.1, parts=4, z=3., n_jobs=None):
+        # indexes and CE of the N features of X (N_sample, F) with the lowest CE, in increasing CE, and the
+        # probability that the set differs from the one of the CE on all samples;
+        # CE is estimated on a stratified subsample with an interval per feature (z times the spread of
+        # the CE over 'parts' disjoint parts of it), only the features whose interval straddles the
+        # cutoff are rescored on a subsample 4 times as large, up to all samples
+        # the bin CE of 'compute' jumps by the 1e-5 floor when a class wins no bin, it is not estimable from a subsample
+        assert (method in ['KMeans_Cross_Entropy_1d', 'KMeans_Cross_Entropy']), "rank needs a KMeans 'method'!"
+        X = X.astype(self.dtype, copy=False)
+        Y = Y.astype('int64').reshape(-1)
+        F = X.shape[1]
+        if N >= F:
+            CE = self.score_parallel(X, Y, method=method, n_jobs=n_jobs)
+            index = np.argsort(CE, kind='stable')
+            return index, CE[index], 0.
+        # stratified order, every prefix holds the classes in the ratio of Y
+        perm = np.random.RandomState(0).permutation(Y.shape[0])
+        pos = np.zeros((Y.shape[0]))
+        for c in np.unique(Y):
+            idx = perm[Y[perm] == c]
+            pos[idx] = (np.arange(idx.shape[0]) + 0.5) / idx.shape[0]
+        order = np.argsort(pos, kind='stable')
+        CE, sigma = np.zeros((F)), np.zeros((F))
+        todo, n = np.arange(F), max(int(frac * Y.shape[0]), parts * self.num_class)
+        while todo.shape[0] > 0:
+            n = min(n, Y.shape[0])
+            x, y = X[np.ix_(order[:n], todo)], Y[order[:n]]
+            CE[todo] = self.score_parallel(x, y, method=method, n_jobs=n_jobs)
+            if n == Y.shape[0]:
+                sigma[todo] = 0
+                break
+            # the interleaved parts are stratified too
+            part = np.array([self.score_parallel(x[k::parts], y[k::parts], method=method, n_jobs=n_jobs) for k in range(parts)])
+            sigma[todo] = np.std(part, axis=0)
+            # cutoff halfway between the N-th and N+1-th lowest CE
+            t = np.mean(np.partition(CE, [N - 1, N])[N - 1:N + 1])
+            scored = todo.shape[0]
+            todo = np.where((np.abs(CE - t) <= z * sigma) & (sigma > 0))[0]
+            print("       <Info>        rank: %d features scored on %d samples, %d to refine"%(scored, n, todo.shape[0]))
+            n *= 4
+        t = np.mean(np.partition(CE, [N - 1, N])[N - 1:N + 1])
+        # union bound of the normal tails beyond the cutoff of the estimated features
+        est = sigma > 0
+        err = np.sum(np.vectorize(math.erfc, otypes=['float64'])(np.abs(CE[est] - t) / sigma[est] / np.sqrt(2)) / 2)
+        index = np.argsort(CE, kind='stable')[:N]
+        return index, CE[index], min(err, 1.)
+
+class DFT():
+    # drop-in for Cross_Entropy in cal_CE_layer / slct_Indexes: compute (and score_parallel with it) scores
+    # every feature by the lowest weighted class entropy, normalized by log(num_class), over the
+    # num_bin - 1 splits at its quantiles, a feature is split into x <= v and x > v, lower is better
+    def __init__(self, num_class, num_bin=64, dtype='float32'):
+        self.num_class = (int)(num_class)
+        self.num_bin = (int)(num_bin)
+        self.dtype = dtype
+
+    def compute(self, x, y, class_weight=None):
+        x = x.astype(self.dtype, copy=False)
+        x = x.reshape(x.shape[0], -1)
+        y = y.astype('int64').reshape(-1)
+        N, F = x.shape
+        S = self.num_bin - 1
+        total = np.bincount(y, minlength=self.num_class)[:self.num_class]
+        # n H(counts) = n log n - sum c log c, c log c of the integer counts from a table
+        xlogx = np.arange(N + 1, dtype='float64')
+        xlogx[1:] *= np.log(xlogx[1:])
+        q = (N * np.arange(1, S + 1)) // (S + 1) - 1
+        loss = np.zeros((F))
+        chunk = max(1, 2**22 // N)
+        for k in range(0, F, chunk):
+            xt = np.ascontiguousarray(x[:, k:k+chunk].T)
+            f, row = xt.shape[0], np.arange(xt.shape[0]).reshape(-1, 1)
+            order = np.argsort(xt, axis=1)
+            xs = np.take_along_axis(xt, order, axis=1)
+            # split j keeps the samples <= xs[q_j] on the left: its prefix ends with the run of values equal to xs[q_j],
+            # the end of the runs of all features from one reverse running minimum
+            end = np.full((f, N), N - 1)
+            np.copyto(end[:, :-1], np.arange(N - 1), where=xs[:, 1:] != xs[:, :-1])
+            pos = np.minimum.accumulate(end[:, ::-1], axis=1)[:, ::-1][:, q] + 1
+            # bin of every sorted sample, the number of prefixes ending at or before it
+            b = np.zeros((f, N + 1), dtype='int64')
+            np.add.at(b, (np.broadcast_to(row, pos.shape), pos), 1)
+            b = np.cumsum(b[:, :N], axis=1)
+            # 2-D bincount over (feature, bin, class), class counts left of split j are the ones of the bins <= j
+            b += row * (S + 1)
+            b *= self.num_class
+            b += y[order]
+            count = np.bincount(b.reshape(-1), minlength=f * (S + 1) * self.num_class).reshape(f, S + 1, self.num_class)
+            left = np.cumsum(count, axis=1)[:, :S]
+            n = np.sum(left, axis=2)
+            H = xlogx[n] + xlogx[N - n] - np.sum(xlogx[left], axis=2) - np.sum(xlogx[total - left], axis=2)
+            # no split at all keeps the entropy of y
+            loss[k:k+chunk] = np.minimum(np.min(H, axis=1, initial=np.inf), xlogx[N] - np.sum(xlogx[total]))
+        return loss / N / math.log(self.num_class)
+
+    def score_parallel(self, X, Y, method='compute', n_jobs=None, start_method=None):
+        # compute of every column of X (N, F) on a pool of processes, see score_parallel_
+        assert (method == 'compute'), "DFT only has 'compute'!"
+        return score_parallel_(self, X, Y, method, n_jobs, start_method)
+
 if __name__ == "__main__":
+    import time
     from sklearn import datasets
+    from sklearn.svm import SVC
     from sklearn.model_selection import train_test_split
     
     print(" > This is a test example: ")
@@ -103,7 +377,39 @@ if __name__ == "__main__":
     # print('training data shape {}'.format(X_train.shape))
     ce = Cross_Entropy(num_class=10, num_bin=5)
     feat_ce = np.zeros(X_train.shape[-1])
+    t0 = time.time()
     for k in range(X_train.shape[-1]):
         feat_ce[k] = ce.KMeans_Cross_Entropy(X_train[:,k].reshape(-1,1), y_train)
         print(" --> KMeans ce: %s"%str(feat_ce[k]))
+    t_kmeans = time.time() - t0
+    # all features in one call, same as one feature at a time
+    bin_ce = ce.compute(X_train, y_train)
+    assert (np.allclose(bin_ce, [ce.compute(X_train[:, k:k+1], y_train)[0] for k in range(X_train.shape[-1])])), "compute error!"
+    print(" --> bin ce: %s"%str(bin_ce))
+    # streamed batch by batch in two passes, same as compute
+    stream = Cross_Entropy(num_class=10, num_bin=5)
+    for b in range(0, X_train.shape[0], 100):
+        stream.partial_range(X_train[b:b+100])
+    for b in range(0, X_train.shape[0], 100):
+        stream.partial_fit(X_train[b:b+100], y_train[b:b+100])
+    assert (np.allclose(stream.finalize(), bin_ce)), "streaming compute error!"
+    # 1-D k-means of all features in one call, close to the MiniBatchKMeans of every feature
+    feat_ce_1d = ce.KMeans_Cross_Entropy_1d(X_train, y_train)
+    assert (np.mean(np.abs(feat_ce_1d - feat_ce)) < 0.01 and np.max(np.abs(feat_ce_1d - feat_ce)) < 0.05), "KMeans_Cross_Entropy_1d error!"
+    print(" --> KMeans 1d ce: %s"%str(feat_ce_1d))
+    # features sharded across processes, in feature order
+    assert (np.allclose(ce.score_parallel(X_train, y_train, method='KMeans_Cross_Entropy_1d', n_jobs=2), feat_ce_1d)), "score_parallel error!"
+    assert (np.allclose(ce.score_parallel(X_train, y_train, method='compute', n_jobs=2), bin_ce)), "score_parallel error!"
+    # top 20 from subsamples, the features left out of the refinement are the ones far from the cutoff
+    index, rank_ce, err = ce.rank(X_train, y_train, 20, frac=0.25, n_jobs=1)
+    print(" --> rank top 20: %s, error probability %f"%(str(sorted(index.tolist())), err))
+    print("     KMeans 1d top 20: %s"%str(sorted(np.argsort(feat_ce_1d, kind='stable')[:20].tolist())))
+    # DFT against KMeans_Cross_Entropy: time and test accuracy of an SVC on the 20 selected features
+    t0 = time.time()
+    dft = DFT(num_class=10, num_bin=16).compute(X_train, y_train)
+    t_dft = time.time() - t0
+    for name, score, t in [('KMeans', feat_ce, t_kmeans), ('DFT', dft, t_dft)]:
+        index = np.argsort(score, kind='stable')[:20]
+        acc = SVC().fit(X_train[:, index], y_train).score(X_test[:, index], y_test)
+        print(" --> %s: %.3fs, test accuracy %.4f on the 20 selected features"%(name, t, acc))
     print("------- DONE -------\n")
@@ -5,11 +5,132 @@
 # Depth goal may not achieved if no nodes's energy is larger than energy threshold or too few SaabArgs/shrinkArgs, (warning generates)
 #
 import numpy as np 
-from saab import Saab
+import time
+from saab import Saab, StackedSaab
 
+def row_slices(n, batch):
+    # slices of 'batch' samples, a short tail is merged into the last slice
+    # so that every chunk still has enough patches for the incremental PCA
+    start = list(range(0, n, batch))
+    if len(start) > 1 and n - start[-1] < batch:
+        start.pop()
+    return [slice(s, e) for s, e in zip(start, start[1:] + [n])]
+
+def integral_(Z, stride):
+    # integral images of Z (G, H, W, ...), one per residue of the rows and columns modulo stride
+    I = {}
+    for r in range(stride):
+        for t in range(stride):
+            z = Z[:, r::stride, t::stride]
+            I[r, t] = np.zeros((z.shape[0], z.shape[1] + 1, z.shape[2] + 1) + z.shape[3:])
+            I[r, t][:, 1:, 1:] = np.cumsum(np.cumsum(z, axis=1, dtype='float64'), axis=2)
+    return I
+
+def patch_stats(X, win, stride, shift, dtype='float32'):
+    # number of patches, sum0 (G, 1, D) and sum2 (G, D, D) of the win x win patches (step 'stride')
+    # of the images X (G, N, H, W, C) minus 'shift' (G, C), patch vectors ordered like view_as_windows
+    # (d = (a * win + b) * C + c); the patches are never built, sum2 is read from integral images of
+    # X times its shift by (dh, dw), one for each of the (2 * win - 1)^2 / 2 offset differences
+    G, N, H, W, C = X.shape
+    H_, W_ = (H - win) // stride + 1, (W - win) // stride + 1
+    X = np.subtract(X, shift.reshape(G, 1, 1, 1, C), dtype=dtype)
+    # samples last: the products below are (C, N) x (N, C) GEMMs for every position
+    Xt = np.ascontiguousarray(np.moveaxis(X, 1, -1))
+    def box(I, a, b):
+        # sum over the patches of the entry at offset (a, b)
+        I, a, b = I[a % stride, b % stride], a // stride, b // stride
+        return I[:, a + H_, b + W_] - I[:, a, b + W_] - I[:, a + H_, b] + I[:, a, b]
+    sum0 = np.zeros((G, win, win, C))
+    sum2 = np.zeros((G, win, win, C, win, win, C))
+    I = integral_(np.sum(X, axis=1, dtype='float64'), stride)
+    for a in range(win):
+        for b in range(win):
+            sum0[:, a, b] = box(I, a, b)
+    for dh in range(win):
+        for dw in range(-win + 1 if dh > 0 else 0, win):
+            # X[q]^T X[q + (dh, dw)] summed over the samples, 0 where q + (dh, dw) is outside
+            w0, w1 = max(0, -dw), min(W, W - dw)
+            Z = np.zeros((G, H, W, C, C), dtype=dtype)
+            Z[:, :H - dh, w0:w1] = np.matmul(Xt[:, :H - dh, w0:w1], np.swapaxes(Xt[:, dh:, w0 + dw:w1 + dw], -1, -2))
+            I = integral_(Z, stride)
+            for a in range(win - dh):
+                for b in range(max(0, -dw), min(win, win - dw)):
+                    sum2[:, a, b, :, a + dh, b + dw] = box(I, a, b)
+                    sum2[:, a + dh, b + dw, :, a, b] = np.swapaxes(sum2[:, a, b, :, a + dh, b + dw], 1, 2)
+    D = win * win * C
+    return N * H_ * W_, sum0.reshape(G, 1, D), sum2.reshape(G, D, D)
+
+def patch_norms(X, win, stride, mean):
+    # squared norms (G, N, H_, W_) of the DC removed win x win patches of X (G, N, H, W, C) minus 'mean'
+    # (G, D), from box sums of X, X^2 and the correlation of X with 'mean', without building the patches
+    G, N, H, W, C = X.shape
+    H_, W_ = (H - win) // stride + 1, (W - win) // stride + 1
+    D, mean = win * win * C, mean.reshape(G, win, win, C).astype('float64')
+    # rows and columns of the patches starting at offset a
+    view = lambda Z, a, b: Z[:, :, a:a + stride * (H_ - 1) + 1:stride, b:b + stride * (W_ - 1) + 1:stride]
+    def box(Z):
+        I = np.zeros((G, N, H + 1, W + 1))
+        I[:, :, 1:, 1:] = np.cumsum(np.cumsum(Z, axis=2, dtype='float64'), axis=3)
+        return view(I, win, win) - view(I, 0, win) - view(I, win, 0) + view(I, 0, 0)
+    # correlation of X with 'mean', summed over the channels at the end
+    corr = np.zeros((G, N, H_, W_, C))
+    for a in range(win):
+        for b in range(win):
+            corr += view(X, a, b) * mean[:, a, b].reshape(G, 1, 1, 1, C)
+    norm = box(np.sum(np.square(X, dtype='float64'), axis=-1)) - 2 * np.sum(corr, axis=-1) + np.sum(np.square(mean), axis=(1, 2, 3)).reshape(G, 1, 1, 1)
+    dc = box(np.sum(X, axis=-1, dtype='float64')) - np.sum(mean, axis=(1, 2, 3)).reshape(G, 1, 1, 1)
+    return norm - np.square(dc) / D
+
+def conv_(X, weight, win, stride, backend, dtype='float32'):
+    # the images X (G, N, H, W, C) correlated with the kernels weight (G, win * win * C, K) at every
+    # win x win patch (step 'stride'): (G, N * H_ * W_, K), same as the view_as_windows patches times weight
+    G, N, H, W, C = X.shape
+    K = weight.shape[-1]
+    H_, W_ = (H - win) // stride + 1, (W - win) // stride + 1
+    weight = weight.reshape(G, win, win, C, K)
+    if backend == 'direct':
+        # one kernel row at a time: the patches of a row are win * C wide instead of win * win * C
+        out = np.zeros((G, N * H_ * W_, K), dtype=dtype)
+        X = np.ascontiguousarray(X)
+        for a in range(win):
+            view = np.lib.stride_tricks.as_strided(X[:, :, a:], shape=(G, N, H_, W_, win, C),
+                                                   strides=X.strides[:2] + (X.strides[2] * stride, X.strides[3] * stride) + X.strides[3:])
+            out += np.matmul(view.reshape(G, -1, win * C), weight[:, a].reshape(G, win * C, K))
+        return out
+    assert (backend == 'fft'), "'backend' must be 'im2col', 'direct', 'fft', 'separable' or 'auto'!"
+    # correlation theorem, the circular wrap-around only reaches positions past the last patch
+    FX = np.fft.rfft2(X.astype(dtype), axes=(2, 3))
+    FW = np.conj(np.fft.rfft2(weight, s=(H, W), axes=(1, 2)))
+    if C == 1:
+        F = FX * FW[:, None, :, :, 0]
+    else:
+        F = np.matmul(FX[..., None, :], FW[:, None])[..., 0, :]
+    out = np.fft.irfft2(F, s=(H, W), axes=(2, 3))[:, :, :stride * (H_ - 1) + 1:stride, :stride * (W_ - 1) + 1:stride]
+    return out.astype(dtype).reshape(G, -1, K)
+
+def conv_separable(X, row, col, win, stride, dtype='float32'):
+    # conv_ with separable kernels (see Saab.compress): sum over r of the row filters row (G, R * K, win * C)
+    # followed by the column filters col (G, R, win, K), both passes are matmul with the image columns last,
+    # the vertical one by a banded (H, H_) matrix per kernel
+    G, N, H, W, C = X.shape
+    R, K = col.shape[1], col.shape[3]
+    H_, W_ = (H - win) // stride + 1, (W - win) // stride + 1
+    X = np.ascontiguousarray(X)
+    s = X.strides
+    view = np.lib.stride_tricks.as_strided(X, shape=(G, win, C, N, W_, H), strides=(s[0], s[3], s[4], s[1], s[3] * stride, s[2]))
+    Y = np.matmul(row, view.reshape(G, win * C, -1)).reshape(G, R, K, N * W_, H)
+    band = np.zeros((G, R, K, H, H_), dtype=dtype)
+    for a in range(win):
+        band[..., np.arange(H_) * stride + a, np.arange(H_)] = col[:, :, a].reshape(G, R, K, 1)
+    out = np.matmul(Y[:, 0], band[:, 0])
+    for r in range(1, R):
+        out += np.matmul(Y[:, r], band[:, r])
+    out = np.transpose(out.reshape(G, K, N, W_, H_), (0, 2, 4, 3, 1))
+    return np.ascontiguousarray(out).reshape(G, -1, K)
 
 class cwSaab():
-    def __init__(self, depth=1, energyTH=0.01, SaabArgs=None, shrinkArgs=None, concatArg=None):
+    def __init__(self, depth=1, energyTH=0.01, SaabArgs=None, shrinkArgs=None, concatArg=None, dtype='float32'):
+        # dtype: floating type of the patches, the outputs and the DC of transform
         self.par = {}
         assert (depth > 0), "'depth' must > 0!"
         self.depth = (int)(depth)
@@ -20,130 +141,492 @@ class cwSaab():
         self.shrinkArgs = shrinkArgs
         assert (concatArg != None), "Need parameter 'concatArg'!"
         self.concatArg = concatArg
+        assert (np.dtype(dtype).kind == 'f'), "'dtype' must be a floating type!"
+        self.dtype = dtype
         self.Energy = []
         self.trained = False
         self.split = False
+        self.plan = []
+        self.backends = {}
+        self.quant = None
         if depth > np.min([len(SaabArgs), len(shrinkArgs)]):
             self.depth = np.min([len(SaabArgs), len(shrinkArgs)])
             print("       <WARNING> Too few 'SaabArgs/shrinkArgs' to get depth %s, actual depth: %s"%(str(depth),str(self.depth)))
 
-    def SaabTransform(self, X, saab, train, layer):
+    def SaabFit(self, X, layer):
+        # fit one Saab on the patches of X, only 'batch' samples are shrunk into patches at a time
         shrinkArg, SaabArg = self.shrinkArgs[layer], self.SaabArgs[layer]
         assert ('func' in shrinkArg.keys()), "shrinkArg must contain key 'func'!"
-        X = shrinkArg['func'](X, shrinkArg)
-        S = list(X.shape)
-        X = X.reshape(-1, S[-1])
-        if SaabArg['num_AC_kernels'] != -1:
-            S[-1] = SaabArg['num_AC_kernels']
-        if train == True:
-            saab = Saab(num_kernels=SaabArg['num_AC_kernels'], useDC=SaabArg['useDC'], needBias=SaabArg['needBias'])
-            saab.fit(X)
-        transformed, dc = saab.transform(X)
-        transformed = transformed.reshape(S)
-        return saab, transformed, dc
+        if SaabArg.get('window_free') == True:
+            saab = Saab(num_kernels=SaabArg['num_AC_kernels'], useDC=SaabArg['useDC'], needBias=SaabArg['needBias'], solver=SaabArg.get('solver', 'eigh'))
+            self.SaabFit_window_free(lambda s: self.images_(X, None, s, layer), X.shape[0], [saab], layer)
+            return saab
+        saab = Saab(num_kernels=SaabArg['num_AC_kernels'], useDC=SaabArg['useDC'], needBias=SaabArg['needBias'], solver=SaabArg.get('solver', 'pca'))
+        if SaabArg.get('batch') == None:
+            X = shrinkArg['func'](X, shrinkArg)
+            saab.fit(X.reshape(-1, X.shape[-1]))
+            return saab
+        shrink = lambda s: shrinkArg['func'](X[s], shrinkArg)
+        slices = row_slices(X.shape[0], SaabArg['batch'])
+        for s in slices:
+            tmp = shrink(s)
+            saab.partial_fit(tmp.reshape(-1, tmp.shape[-1]))
+        saab.end_fit()
+        if saab.needBias == True:
+            for s in slices:
+                tmp = shrink(s)
+                saab.partial_bias(tmp.reshape(-1, tmp.shape[-1]))
+        return saab
+
+    def SaabFit_stacked(self, X, idx, layer):
+        # fit one Saab for each channel X[idx[c]] (X is channel first) with stacked covariances
+        shrinkArg, SaabArg = self.shrinkArgs[layer], self.SaabArgs[layer]
+        def shrink(s):
+            tmp = X[idx, s].astype(self.dtype, copy=False)
+            tmp = shrinkArg['func'](tmp.reshape((-1,) + tmp.shape[2:] + (1,)), shrinkArg)
+            return tmp.reshape(len(idx), -1, tmp.shape[-1])
+        # all channels of 'batch' samples are stacked, a chunk is len(idx) times larger than in SaabFit
+        slices = row_slices(X.shape[1], X.shape[1] if SaabArg.get('batch') == None else SaabArg['batch'])
+        saab_cur = [Saab(num_kernels=SaabArg['num_AC_kernels'], useDC=SaabArg['useDC'], needBias=SaabArg['needBias'], solver=SaabArg.get('solver', 'eigh')) for i in idx]
+        if SaabArg.get('window_free') == True:
+            self.SaabFit_window_free(lambda s: self.images_(X, idx, s, layer), X.shape[1], saab_cur, layer)
+            return saab_cur
+        stacked = StackedSaab(saab_cur)
+        for s in slices:
+            tmp = shrink(s)
+            stacked.partial_fit(tmp)
+        stacked.end_fit()
+        if SaabArg['needBias'] == True:
+            for s in slices:
+                # a single chunk is still at hand from the first pass
+                stacked.partial_bias(shrink(s) if len(slices) > 1 else tmp)
+        return saab_cur
 
+    def pre_(self, X, layer):
+        # shrinkArg 'pre': callback applied to the images before they are cut into patches
+        shrinkArg = self.shrinkArgs[layer]
+        return X if shrinkArg.get('pre') is None else shrinkArg['pre'](X, shrinkArg)
 
-    def cwSaab_1_layer(self, X, train):
-        if train == True:
-            saab_cur = []
-        else:
-            saab_cur = self.par['Layer'+str(0)]
-        transformed, eng, DC = [], [], []
-        if self.SaabArgs[0]['cw'] == True:
-            S = list(X.shape)
-            S[-1] = 1
+    def images_(self, X, idx, s, layer):
+        # images (G, n, H, W, C) of the samples s after shrinkArg 'pre': all channels of X (N, H, W, C)
+        # if idx is None, else one stack per channel X[idx[g]] of the channel first X
+        if idx is None:
+            return self.pre_(X[s], layer)[None]
+        tmp = self.pre_(X[idx, s].reshape((-1,) + X.shape[2:] + (1,)), layer)
+        return tmp.reshape((len(idx), -1) + tmp.shape[1:])
+
+    def SaabFit_window_free(self, images, N, saabs, layer):
+        # fit the Saabs from patch statistics taken on the images (G, n, H, W, C) returned by images(s)
+        # for a slice s of the N samples, the patch geometry is shrinkArg 'win' and 'stride'
+        shrinkArg, SaabArg = self.shrinkArgs[layer], self.SaabArgs[layer]
+        assert ('win' in shrinkArg.keys() and 'stride' in shrinkArg.keys()), "'window_free' needs shrinkArg keys 'win' and 'stride'!"
+        win, stride = shrinkArg['win'], shrinkArg['stride']
+        slices = row_slices(N, N if SaabArg.get('batch') == None else SaabArg['batch'])
+        stacked, shift = StackedSaab(saabs), None
+        for s in slices:
+            tmp = images(s)
+            if shift is None:
+                shift = np.mean(tmp, axis=(1, 2, 3), dtype=self.dtype)
+            num, sum0, sum2 = patch_stats(tmp, win, stride, shift, self.dtype)
+            stacked.partial_fit_stats(num, sum0, sum2, np.tile(shift, win * win)[:, None, :])
+        stacked.end_fit()
+        if SaabArg['needBias'] == True:
+            for s in slices:
+                # a single chunk is still at hand from the first pass
+                norm = patch_norms(images(s) if len(slices) > 1 else tmp, win, stride, stacked.Mean0)
+                stacked.update_bias(np.sqrt(np.max(np.maximum(norm, 0), axis=(1, 2, 3))) * 1 / np.sqrt(stacked.Mean0.shape[-1]))
+        return saabs
+
+    def input_(self, layer, prev=None):
+        # parent channel of every Saab in 'layer': index into the full output of layer-1 (Energy),
+        # and position among the columns that the plan 'prev' of layer-1 computes
+        if layer == 0:
+            idx = np.arange(len(self.par['Layer'+str(0)])) if self.SaabArgs[0]['cw'] == True else None
+            return idx, idx
+        eng_prev = np.concatenate([saab.Energy for saab in self.par['Layer'+str(layer-1)]], axis=0)
+        idx = np.where(eng_prev >= self.energyTH)[0]
+        cols = (self.plan[layer-1] if prev is None else prev)['cols']
+        if cols is None:
+            return idx, idx
+        pos = np.minimum(np.searchsorted(cols, idx), len(cols)-1)
+        # -1: parent not computed by 'prev'
+        return idx, np.where(cols[pos] == idx, pos, -1)
+
+    def keep_(self, layer):
+        # output channels of a layer that transform has to compute, None: all of them
+        return None
+
+    def compile_layer(self, layer, prev=None, keep=None, sparse=None, rows=None):
+        # transform plan of a trained layer: kernels of its Saab stacked into (G, D, n) tensors,
+        # one group per number of kept kernels, so that dropped channels are never projected
+        #   prev: plan of layer-1 (default self.plan[layer-1])
+        #   keep: (C*K,) output channels to compute (default keep_(layer))
+        #   sparse, rows: (C*K,) channels only computed at the flattened spatial positions 'rows'
+        # plan['idx']: input channel of each needed Saab (None: one Saab on all channels)
+        saab_cur = self.par['Layer'+str(layer)]
+        C, K = len(saab_cur), saab_cur[0].Weight.shape[1]
+        if keep is None:
+            keep = self.keep_(layer)
+        keep = np.ones((C, K), dtype=bool) if keep is None else keep.reshape(C, K)
+        sparse = np.zeros((C, K), dtype=bool) if sparse is None else sparse.reshape(C, K) & keep
+        need = np.where(np.sum(keep, axis=1) > 0)[0]
+        parent, idx = self.input_(layer, prev)
+        assert (idx is None or np.all(idx[need] >= 0)), "Parent channels of layer %s are not computed!"%str(layer)
+        pos = np.cumsum(keep.reshape(-1)).reshape(C, K) - 1
+        plan = {'idx': None if idx is None else idx[need],
+                'cols': None if np.all(keep) else np.where(keep.reshape(-1))[0],
+                'width': int(np.sum(keep)),
+                'Offset_dc': np.array([saab_cur[c].Offset_dc for c in need]).reshape(-1, 1),
+                'groups': []}
+        if self.quant is not None:
+            # scale of the input channels of the needed Saabs and of the output columns (None: float16)
+            Out = self.quant['Out']
+            scale = self.quant['scale'] if layer == 0 else 1 if Out[layer-1] is None else Out[layer-1][parent[need]]
+            plan['quant'] = {'In': np.broadcast_to(scale, (len(need),)).reshape(-1, 1).astype('float32'),
+                             'Out': None if Out[layer] is None else Out[layer][keep.reshape(-1)]}
+        entries = [(c, np.where(keep[c] & (sparse[c] == flag))[0], flag) for c in need for flag in [False, True]]
+        entries = [e for e in entries if len(e[1]) > 0]
+        for n, flag in sorted(set((len(k), flag) for _, k, flag in entries)):
+            group = [e for e in entries if len(e[1]) == n and e[2] == flag]
+            c = np.array([e[0] for e in group])
+            k = np.array([e[1] for e in group])
+            cols = pos[c.reshape(-1, 1), k].reshape(-1)
+            dense = flag == False and len(group) == len(need) and np.array_equal(cols, np.arange(plan['width']))
+            plan['groups'].append({'chan': None if dense else np.searchsorted(need, c),
+                                   'cols': None if dense else cols,
+                                   'rows': rows if flag == True else None,
+                                   'Weight': np.array([saab_cur[cc].Weight[:, kk] for cc, kk in zip(c, k)]),
+                                   'Offset': np.array([saab_cur[cc].Offset[:, kk] for cc, kk in zip(c, k)])})
+            if self.quant is not None:
+                # integer kernels as float32 for BLAS, exact as long as the dot products stay below 2**24,
+                # 'Scale' folds the scales of the kernels and of the input channels
+                group = plan['groups'][-1]
+                group['Weight'] = np.array([saab_cur[cc].Quant['Weight'][:, kk] for cc, kk in zip(c, k)]).astype('float32')
+                group['Scale'] = np.array([saab_cur[cc].Quant['Scale'][:, kk] for cc, kk in zip(c, k)]) * plan['quant']['In'][np.searchsorted(need, c)].reshape(-1, 1, 1)
+                if plan['quant']['Out'] is not None:
+                    group['Out'] = 1 / plan['quant']['Out'][cols].reshape(len(c), 1, n)
+            elif np.all([saab.Separable is not None for saab in saab_cur]):
+                # separable factors, zero-padded to the largest rank of the layer
+                R = np.max([saab.Separable['Row'].shape[1] for saab in saab_cur])
+                pad = lambda F, kk: np.pad(F[kk], [(0, 0), (0, R - F.shape[1]), (0, 0)])
+                row = np.array([pad(saab_cur[cc].Separable['Row'], kk) for cc, kk in zip(c, k)])
+                col = np.array([pad(saab_cur[cc].Separable['Col'], kk) for cc, kk in zip(c, k)])
+                plan['groups'][-1]['Row'] = np.ascontiguousarray(np.transpose(row, (0, 2, 1, 3)).reshape(len(c), R * n, -1))
+                plan['groups'][-1]['Col'] = np.ascontiguousarray(np.transpose(col, (0, 2, 3, 1)))
+        return plan
+
+    def compile(self):
+        assert (self.trained == True), "Must call fit first!"
+        self.plan = []
+        for i in range(self.depth):
+            self.plan.append(self.compile_layer(i))
+
+    def SaabTransform(self, X, layer, needDC=True, plan=None, poolArg=None, feed=None):
+        # every Saab of a layer applied by a few batched matmul, only 'batch' samples are shrunk at a time
+        # positions outside the 'rows' of a sparse group are left uninitialized
+        # poolArg: {'func': callback, ...} pooling the output of every batch as soon as it is computed,
+        #   returns (pooled, DC, output[..., feed]) so that only the columns 'feed' stay at full resolution
+        # SaabArg 'backend': 'im2col' (default) multiplies the patches of the shrinkArg 'func' callback,
+        #   'direct' and 'fft' convolve the images (see conv_), 'auto' times the three of them on the
+        #   first samples of every hop shape and keeps the fastest (cached in self.backends),
+        #   'separable' runs the 1-D passes of the kernels cut by compress (see conv_separable)
+        # quantized plans (see quantize) output int8 or float16
+        shrinkArg, SaabArg = self.shrinkArgs[layer], self.SaabArgs[layer]
+        plan = self.plan[layer] if plan is None else plan
+        quant = plan.get('quant')
+        dtype = self.dtype if quant is None else ('float16' if quant['Out'] is None else 'int8')
+        if quant is not None and layer == 0:
+            X = self.quant_input_(X)
+        C = plan['Offset_dc'].shape[0]
+        if plan['idx'] is not None:
             X = np.moveaxis(X, -1, 0)
-            for i in range(X.shape[0]):
-                X_tmp = X[i].reshape(S)
-                if train == True:
-                    saab, tmp_transformed, dc = self.SaabTransform(X_tmp, saab=None, train=True, layer=0)
-                    saab_cur.append(saab)
-                    eng.append(saab.Energy)
+        N = X.shape[0] if plan['idx'] is None else X.shape[1]
+        backend = SaabArg.get('backend', 'im2col')
+        if backend != 'im2col':
+            assert ('win' in shrinkArg.keys() and 'stride' in shrinkArg.keys()), "'backend' needs shrinkArg keys 'win' and 'stride'!"
+        if np.any([group['rows'] is not None for group in plan['groups']]):
+            # sparse groups gather their rows from the patches
+            backend = 'im2col'
+        separable = np.all(['Row' in group.keys() for group in plan['groups']])
+        assert (backend != 'separable' or separable), "'separable' backend needs compress first!"
+        def shrink(s, backend):
+            # patches (C, M, D) or images (C, n, H, W, c) of the samples s, and the shape of the patches
+            if backend != 'im2col':
+                img = self.images_(X, plan['idx'], s, layer)
+                win, stride = shrinkArg['win'], shrinkArg['stride']
+                return img, [C * img.shape[1], (img.shape[2] - win) // stride + 1, (img.shape[3] - win) // stride + 1, win * win * img.shape[-1]]
+            if plan['idx'] is None:
+                tmp = shrinkArg['func'](X[s], shrinkArg)
+            else:
+                tmp = X[plan['idx'], s]
+                tmp = shrinkArg['func'](tmp.reshape((-1,) + tmp.shape[2:] + (1,)), shrinkArg)
+            return tmp.reshape(C, -1, tmp.shape[-1]), list(tmp.shape)
+        def apply(tmp, S, out, backend):
+            for group in plan['groups']:
+                patch = tmp if group['chan'] is None else tmp[group['chan']]
+                if backend == 'separable':
+                    res = conv_separable(patch, group['Row'], group['Col'], shrinkArg['win'], shrinkArg['stride'], self.dtype)
+                elif backend != 'im2col':
+                    res = conv_(patch, group['Weight'], shrinkArg['win'], shrinkArg['stride'], backend, self.dtype)
                 else:
-                    if len(saab_cur) == i:
-                        break
-                    _, tmp_transformed, dc = self.SaabTransform(X_tmp, saab=saab_cur[i], train=False, layer=0)
-                transformed.append(tmp_transformed)
-                DC.append(dc)
-            transformed = np.concatenate(transformed, axis=-1)
-        else:
-            if train == True:
-                saab, transformed, dc = self.SaabTransform(X, saab=None, train=True, layer=0)
-                saab_cur.append(saab)
-                eng.append(saab.Energy)
+                    if group['rows'] is not None:
+                        patch = patch.reshape(patch.shape[0], -1, np.prod(S[1:-1]), S[-1])[:, :, group['rows']]
+                        patch = patch.reshape(patch.shape[0], -1, S[-1])
+                    res = np.matmul(patch, group['Weight'])
+                if quant is not None:
+                    res *= group['Scale']
+                res += group['Offset']
+                if 'Out' in group.keys():
+                    res *= group['Out']
+                    np.clip(np.rint(res, out=res), -127, 127, out=res)
+                res = np.swapaxes(res, 0, 1).reshape(res.shape[1], -1)
+                if group['cols'] is None:
+                    np.copyto(out, res, casting='unsafe')
+                elif group['rows'] is None:
+                    out[:, group['cols']] = res
+                else:
+                    out = out.reshape(-1, np.prod(S[1:-1]), plan['width'])
+                    out[:, group['rows'].reshape(-1, 1), group['cols']] = res.reshape(out.shape[0], len(group['rows']), -1)
+                    out = out.reshape(-1, plan['width'])
+        output, DC, pooled, scratch = None, None, None, None
+        for s in row_slices(N, N if SaabArg.get('batch') == None else SaabArg['batch']):
+            if backend == 'auto':
+                key = (layer, C) + X.shape[1 if plan['idx'] is None else 2:]
+                if key not in self.backends.keys():
+                    # timed on a few samples, the output is not touched
+                    cost, t = {}, slice(s.start, min(s.stop, s.start + 32))
+                    for b in ['im2col', 'direct', 'fft'] + (['separable'] if separable else []):
+                        t0 = time.time()
+                        tmp, S = shrink(t, b)
+                        apply(tmp, S, np.empty((S[0] // C * np.prod(S[1:-1]), plan['width']), dtype=dtype), b)
+                        cost[b] = time.time() - t0
+                    self.backends[key] = min(cost, key=cost.get)
+                backend = self.backends[key]
+            tmp, S = shrink(s, backend)
+            if output is None:
+                output = np.empty([N] + S[1:-1] + [plan['width'] if poolArg is None else len(feed)], dtype=dtype)
+                if needDC == True:
+                    DC = np.empty((C, N, np.prod(S[1:-1], dtype='int64')), dtype=self.dtype)
+            if poolArg is None:
+                out = output[s].reshape(-1, plan['width'])
             else:
-                _, transformed, dc = self.SaabTransform(X, saab=saab_cur[0], train=False, layer=0)
-            DC.append(dc)
-                
+                # the last batch may hold the merged tail
+                if scratch is None or scratch.shape[0] < S[0] // C * np.prod(S[1:-1]):
+                    scratch = np.empty((S[0] // C * np.prod(S[1:-1]), plan['width']), dtype=dtype)
+                out = scratch[:S[0] // C * np.prod(S[1:-1])]
+            apply(tmp, S, out, backend)
+            if poolArg is not None:
+                out = out.reshape([-1] + S[1:-1] + [plan['width']])
+                res = poolArg['func'](out, poolArg)
+                if pooled is None:
+                    pooled = np.empty((N,) + res.shape[1:], dtype=self.dtype)
+                pooled[s] = res
+                np.take(out, feed, axis=-1, out=output[s])
+            if needDC == True:
+                if backend == 'im2col':
+                    dc = np.mean(tmp, axis=2, dtype=self.dtype)
+                else:
+                    dc = conv_(tmp, np.full((C, S[-1], 1), 1 / S[-1], dtype=self.dtype), shrinkArg['win'], shrinkArg['stride'], 'direct', self.dtype)[..., 0]
+                if quant is not None:
+                    dc *= quant['In']
+                DC[:, s] = (dc + plan['Offset_dc']).reshape(C, -1, DC.shape[2])
+        if needDC == True:
+            DC = [dc.reshape(-1, 1) for dc in DC]
+        if poolArg is not None:
+            return pooled, DC, output
+        return output, DC
+
+    def cwSaab_1_layer(self, X, train, needDC=True):
         if train == True:
+            if self.SaabArgs[0]['cw'] == True and self.SaabArgs[0].get('cw_stack') == True:
+                saab_cur = self.SaabFit_stacked(np.moveaxis(X, -1, 0), np.arange(X.shape[-1]), layer=0)
+            elif self.SaabArgs[0]['cw'] == True:
+                saab_cur = [self.SaabFit(X[..., i:i+1], layer=0) for i in range(X.shape[-1])]
+            else:
+                saab_cur = [self.SaabFit(X, layer=0)]
             self.par['Layer'+str(0)] = saab_cur
-            self.Energy.append(np.concatenate(eng, axis=0))
-        return transformed, DC
-
-    def cwSaab_n_layer(self, X, train, layer):
-        output, eng_cur, DC, ct, pidx = [], [], [], -1, 0
-        S = list(X.shape)
-        S[-1] = 1
-        X = np.moveaxis(X, -1, 0)
-        saab_prev = self.par['Layer'+str(layer-1)]
+            self.Energy.append(np.concatenate([saab.Energy for saab in saab_cur], axis=0))
+            self.plan = [self.compile_layer(0)]
+        return self.SaabTransform(X, layer=0, needDC=needDC)
+
+    def cwSaab_n_layer(self, X, train, layer, needDC=True):
         if train == True:
-            saab_cur = []
-        else:
-            saab_cur = self.par['Layer'+str(layer)]
-        for i in range(len(saab_prev)):
-            for j in range(saab_prev[i].Energy.shape[0]):
-                ct += 1
-                if saab_prev[i].Energy[j] < self.energyTH:
-                    continue
-                self.split = True
-                X_tmp = X[ct].reshape(S)
-                if train == True:
-                    saab, out_tmp, dc = self.SaabTransform(X_tmp, saab=None, train=True, layer=layer)
-                    saab.Energy *= saab_prev[i].Energy[j]
-                    saab_cur.append(saab)
-                    eng_cur.append(saab.Energy) 
-                else:
-                    _, out_tmp, dc = self.SaabTransform(X_tmp, saab=saab_cur[pidx], train=False, layer=layer)
-                    pidx += 1
-                output.append(out_tmp)
-                DC.append(dc)
-        if self.split == True:
-            output = np.concatenate(output, axis=-1)
-            if train == True:
-                self.par['Layer'+str(layer)] = saab_cur
-                self.Energy.append(np.concatenate(eng_cur, axis=0))
-        return output, DC
+            eng_prev = np.concatenate([saab.Energy for saab in self.par['Layer'+str(layer-1)]], axis=0)
+            idx, pos = self.input_(layer)
+            self.split = len(idx) > 0
+            if self.split == False:
+                return [], []
+            if self.SaabArgs[layer].get('cw_stack') == True:
+                saab_cur = self.SaabFit_stacked(np.moveaxis(X, -1, 0), pos, layer=layer)
+            else:
+                saab_cur = [self.SaabFit(X[..., i:i+1], layer=layer) for i in pos]
+            for i, saab in zip(idx, saab_cur):
+                saab.Energy *= eng_prev[i]
+            self.par['Layer'+str(layer)] = saab_cur
+            self.Energy.append(np.concatenate([saab.Energy for saab in saab_cur], axis=0))
+            self.plan = self.plan[:layer] + [self.compile_layer(layer)]
+        return self.SaabTransform(X, layer=layer, needDC=needDC)
     
-    def fit(self, X):
-#        output, DC = [], []
-        X, dc = self.cwSaab_1_layer(X, train=True)
-#        output.append(X)
-#        DC.append(dc)
+    def fit_(self, X, needDC=False, poolArgs=None, output=None, DC=None):
+        # the output of every layer computed while fitting is appended to 'output' (pooled by poolArgs)
+        if poolArgs is None:
+            poolArgs = [None] * self.depth
+        self.quant = None
+        X, dc = self.cwSaab_1_layer(X, train=True, needDC=needDC)
+        if output is not None:
+            output.append(X if poolArgs[0] is None else poolArgs[0]['func'](X, poolArgs[0]))
+            DC.append(dc)
         for i in range(1, self.depth):
-            X, dc = self.cwSaab_n_layer(X, train=True, layer=i)
-#            output.append(X)
-#            DC.append(dc)
+            X, dc = self.cwSaab_n_layer(X, train=True, layer=i, needDC=needDC)
             if self.split == False:
                 self.depth = i
                 print("       <WARNING> Cannot futher split, actual depth: %s"%str(i))
                 break
+            if output is not None:
+                output.append(X if poolArgs[i] is None else poolArgs[i]['func'](X, poolArgs[i]))
+                DC.append(dc)
         self.trained = True
-#        output = self.concatArg['func'](output, self.concatArg)
-#        return output, DC
 
-    def transform(self, X):
+    def fit(self, X):
+        self.fit_(X)
+
+    def fit_transform(self, X, needDC=True, poolArgs=None):
+        # fit, and return the outputs computed while fitting, same as fit(X) followed by transform(X)
+        output, DC = [], []
+        self.fit_(X, needDC=needDC, poolArgs=poolArgs, output=output, DC=DC)
+        output = self.concatArg['func'](output, self.concatArg)
+        return output, DC
+
+    def transform(self, X, needDC=True, poolArgs=None):
+        # poolArgs[i]: pooling of the output of layer i (see SaabTransform), None to keep it at full resolution
         assert (self.trained == True), "Must call fit first!"
+        if len(self.plan) < self.depth:
+            self.compile()
+        if poolArgs is None:
+            poolArgs = [None] * self.depth
         output, DC = [], []
-        X, dc = self.cwSaab_1_layer(X, train=False)
-        output.append(X)
-        DC.append(dc)
-        for i in range(1, self.depth):
-            X, dc = self.cwSaab_n_layer(X, train=False, layer=i)
-            output.append(X)
+        for i in range(self.depth):
+            plan = self.plan[i]
+            if i > 0 and poolArgs[i-1] is not None:
+                # X only holds the channels feeding this layer
+                plan = dict(plan, idx=np.arange(len(plan['idx'])))
+            if poolArgs[i] is None:
+                X, dc = self.SaabTransform(X, i, needDC=needDC, plan=plan)
+                output.append(self.dequantize_(X, plan))
+            else:
+                feed = self.plan[i+1]['idx'] if i < self.depth - 1 else []
+                out, dc, X = self.SaabTransform(X, i, needDC=needDC, plan=plan, poolArg=poolArgs[i], feed=feed)
+                output.append(self.dequantize_(out, plan))
             DC.append(dc)
         assert ('func' in self.concatArg.keys()), "'concatArg' must have key 'func'!"
         output = self.concatArg['func'](output, self.concatArg)
         return output, DC
+
+    def compress(self, X, tol=0.05, max_rank=None):
+        # separable approximation of the kernels of every layer (see Saab.compress), reports per hop the
+        # kernel error, the output error on the samples X and the time of backend 'separable' against
+        # the SaabArg 'backend' ('im2col' when it is 'separable'); the caller's backend is restored after
+        # the timings, so 'separable' or 'auto' run the 1-D passes from then on
+        assert (self.trained == True), "Must call fit first!"
+        if len(self.plan) < self.depth:
+            self.compile()
+        self.backends = {}
+        report = []
+        for i in range(self.depth):
+            SaabArg, win = self.SaabArgs[i], self.shrinkArgs[i]['win']
+            has_backend, orig = 'backend' in SaabArg.keys(), SaabArg.get('backend', 'im2col')
+            backend = 'im2col' if orig == 'separable' else orig
+            try:
+                # reference: the full kernels
+                for saab in self.par['Layer'+str(i)]:
+                    saab.Separable = None
+                    saab.fold_()
+                self.plan[i] = self.compile_layer(i)
+                SaabArg['backend'] = backend
+                t0 = time.time()
+                ref, _ = self.SaabTransform(X, i, needDC=False)
+                t_ref = time.time() - t0
+                for saab in self.par['Layer'+str(i)]:
+                    saab.compress(win, tol=tol, max_rank=max_rank)
+                self.plan[i] = self.compile_layer(i)
+                SaabArg['backend'] = 'separable'
+                t0 = time.time()
+                out, _ = self.SaabTransform(X, i, needDC=False)
+                t_sep = time.time() - t0
+            finally:
+                if has_backend:
+                    SaabArg['backend'] = orig
+                else:
+                    SaabArg.pop('backend')
+            rank = np.concatenate([saab.Separable['rank'] for saab in self.par['Layer'+str(i)]])
+            error = np.concatenate([saab.Separable['error'] for saab in self.par['Layer'+str(i)]])
+            report.append({'rank': np.mean(rank), 'max_rank': np.max(rank), 'kernel_error': np.max(error),
+                           'output_error': np.linalg.norm(out - ref) / np.linalg.norm(ref),
+                           'time': t_ref, 'time_separable': t_sep, 'speedup': t_ref / t_sep})
+            print("       Hop %s: rank %.2f (max %s), kernel error %.4f, output error %.4f, %s %.3fs -> separable %.3fs (x%.2f)"%(
+                  str(i+1), report[-1]['rank'], str(report[-1]['max_rank']), report[-1]['kernel_error'],
+                  report[-1]['output_error'], backend, t_ref, t_sep, report[-1]['speedup']))
+            X = ref
+        # 'auto' picked its backends on the full kernels
+        self.backends = {}
+        return report
+
+    def quant_input_(self, X):
+        # input of a quantized model in units of 'scale': integer X is taken as is, float X is divided
+        # by scale (and rounded for int8)
+        if X.dtype.kind in 'iu':
+            return X if self.quant['dtype'] == 'int8' else X.astype('float16')
+        if self.quant['dtype'] == 'float16':
+            return (X / self.quant['scale']).astype('float16')
+        X = np.rint(X / self.quant['scale'])
+        return X.astype('uint8' if np.min(X) >= 0 and np.max(X) <= 255 else 'int16')
+
+    def dequantize_(self, X, plan):
+        # dtype output of a (quantized) plan, the pooled outputs are already in dtype
+        quant = plan.get('quant')
+        if quant is None:
+            return X
+        X = X.astype(self.dtype, copy=False)
+        if quant['Out'] is not None:
+            X *= quant['Out']
+        return X
+
+    def quantize(self, X, dtype='int8', scale=1):
+        # quantized inference: int8 kernels with one scale per kernel and int8 layer outputs with one scale
+        # per channel calibrated on the samples X (or float16 kernels and outputs), integer input is X * scale
+        # (e.g. the uint8 images and scale=1/255); the matmul accumulate in float32, exact for integers,
+        # transform returns dtype while the patches and the outputs fed to the next layer stay quantized
+        # returns the error of every layer output against the float path on X
+        assert (self.trained == True), "Must call fit first!"
+        assert (dtype in ['int8', 'float16']), "'dtype' must be 'int8' or 'float16'!"
+        self.quant = None
+        self.backends = {}
+        self.compile()
+        ref, tmp = [], X.astype(self.dtype) * np.dtype(self.dtype).type(scale) if X.dtype.kind in 'iu' else X
+        for i in range(self.depth):
+            tmp, _ = self.SaabTransform(tmp, i, needDC=False)
+            ref.append(tmp)
+        Out = []
+        for i in range(self.depth):
+            for saab in self.par['Layer'+str(i)]:
+                saab.quantize(dtype)
+            if dtype == 'float16':
+                Out.append(None)
+                continue
+            mx = np.max(np.abs(ref[i].reshape(-1, ref[i].shape[-1])), axis=0) / 127
+            Out.append(np.ones(len(self.Energy[i]), dtype='float32'))
+            Out[i][slice(None) if self.plan[i]['cols'] is None else self.plan[i]['cols']] = np.where(mx > 0, mx, 1)
+        self.quant = {'dtype': dtype, 'scale': scale, 'Out': Out}
+        self.compile()
+        report, tmp = [], X
+        for i in range(self.depth):
+            tmp, _ = self.SaabTransform(tmp, i, needDC=False)
+            out = self.dequantize_(tmp, self.plan[i])
+            report.append({'error': np.linalg.norm(out - ref[i]) / np.linalg.norm(ref[i]), 'max_error': np.max(np.abs(out - ref[i])),
+                           'bytes': tmp.nbytes, 'bytes_float': ref[i].nbytes})
+            print("       Hop %s: %s relative error %.5f, max error %.5f, output %.1fMB -> %.1fMB"%(str(i+1), dtype,
+                  report[-1]['error'], report[-1]['max_error'], ref[i].nbytes / 2**20, tmp.nbytes / 2**20))
+        return report
     
         
 if __name__ == "__main__":
@@ -180,4 +663,41 @@ if __name__ == "__main__":
     cwsaab = cwSaab(depth=2, energyTH=0.001, SaabArgs=SaabArgs, shrinkArgs=shrinkArgs, concatArg=concatArg)
     cwsaab.fit(X)
     output, DC = cwsaab.transform(X)
+    print(" -----> depth=2, batch=500, solver='eigh', cw_stack=True")
+    SaabArgs = [{'num_AC_kernels':-1, 'needBias':False, 'useDC':True, 'cw': True, 'batch':500, 'solver':'eigh', 'cw_stack':True}, 
+                {'num_AC_kernels':-1, 'needBias':True, 'useDC':True, 'cw': True, 'batch':500, 'solver':'eigh', 'cw_stack':True}]
+    cwsaab = cwSaab(depth=2, energyTH=0.001, SaabArgs=SaabArgs, shrinkArgs=shrinkArgs, concatArg=concatArg)
+    cwsaab.fit(X)
+    output_stack, DC = cwsaab.transform(X)
+    assert (np.max(np.abs(output_stack[0] - output[0])) < 1e-3), "cw_stack error!"
+    print(" -----> depth=2, batch=500, solver='eigh', cw_stack=True, window_free=True")
+    for SaabArg in SaabArgs:
+        SaabArg['window_free'] = True
+    cwsaab = cwSaab(depth=2, energyTH=0.001, SaabArgs=SaabArgs, shrinkArgs=shrinkArgs, concatArg=concatArg)
+    cwsaab.fit(X)
+    output_free, DC = cwsaab.transform(X)
+    for i in range(2):
+        assert (np.max(np.abs(output_free[i] - output_stack[i])) < 1e-3), "window_free error!"
+    print(" -----> backend='direct', 'fft', 'auto'")
+    for backend in ['direct', 'fft', 'auto']:
+        for SaabArg in SaabArgs:
+            SaabArg['backend'] = backend
+        output_conv, DC_conv = cwsaab.transform(X)
+        for i in range(2):
+            assert (np.max(np.abs(output_conv[i] - output_free[i])) < 1e-4), "%s backend error!"%backend
+            assert (np.max(np.abs(np.array(DC_conv[i]) - np.array(DC[i]))) < 1e-4), "%s backend DC error!"%backend
+    print(" -----> compress, backend='separable'")
+    for SaabArg in SaabArgs:
+        SaabArg['backend'] = 'im2col'
+    report = cwsaab.compress(X, tol=0.0, max_rank=None)
+    for i in range(2):
+        assert (report[i]['output_error'] < 1e-4), "exact compress error!"
+    for SaabArg in SaabArgs:
+        SaabArg['backend'] = 'separable'
+    output_sep, DC_sep = cwsaab.transform(X)
+    for i in range(2):
+        assert (np.max(np.abs(output_sep[i] - output_free[i])) < 1e-4), "separable backend error!"
+    report = cwsaab.compress(X, tol=0.5, max_rank=1)
+    assert (np.all([r['max_rank'] == 1 for r in report])), "max_rank error!"
+    assert (np.all([SaabArg['backend'] == 'separable' for SaabArg in SaabArgs])), "compress backend restore error!"
     print("------- DONE -------\n")
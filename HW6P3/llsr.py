@@ -2,18 +2,20 @@
 import numpy as np
 from sklearn.metrics import accuracy_score
 class LLSR():
-    def __init__(self, onehot=True, normalize=False):
+    def __init__(self, onehot=True, normalize=False, dtype='float32'):
         self.onehot = onehot
         self.normalize = normalize
+        self.dtype = dtype
         self.weight = []
         self.trained = False
 
     def fit(self, X, Y):
         if self.onehot == True:
-            Y = np.eye(len(np.unique(Y)))[Y.reshape(-1)]
-        A = np.ones((X.shape[0], 1))
-        X = np.concatenate((X, A), axis=1)
-        self.weight, _, _, _ = np.linalg.lstsq(X, Y, rcond=None)
+            Y = np.eye(len(np.unique(Y)), dtype=self.dtype)[Y.reshape(-1)]
+        # solved in self.dtype, a float64 column of ones would promote X
+        A = np.ones((X.shape[0], 1), dtype=self.dtype)
+        X = np.concatenate((X.astype(self.dtype, copy=False), A), axis=1)
+        self.weight, _, _, _ = np.linalg.lstsq(X, Y.astype(self.dtype, copy=False), rcond=None)
         self.trained = True
 
     def predict(self, X):
@@ -23,9 +25,9 @@ class LLSR():
 
     def predict_proba(self, X):
         assert (self.trained == True), "Must call fit first!"
-        A = np.ones((X.shape[0], 1))
-        X = np.concatenate((X, A), axis=1)
-        pred = np.matmul(X, self.weight)
+        # the last row of the weight is the bias, added to the product instead of a column of ones to X
+        pred = np.matmul(X.astype(self.dtype, copy=False), self.weight[:-1])
+        pred += self.weight[-1]
         if self.normalize == True:
             pred = (pred - np.min(pred, axis=1, keepdims=True))/ np.sum((pred - np.min(pred, axis=1, keepdims=True) + 1e-15), axis=1, keepdims=True)
         return pred
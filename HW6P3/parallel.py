@@ -0,0 +1,17 @@
+# 2020.04.25
+# process pool shared by the libraries
+#
+#   pool_map: a function over a list of tasks on a pool of processes, in task order
+import sys
+import multiprocessing
+
+def pool_map(func, tasks, n_jobs, start_method=None):
+    # [func(t) for t in tasks] on a pool of n_jobs processes, in process with a single job;
+    # start_method: default fork on Linux, which does not re-import the calling script in the workers,
+    # elsewhere the platform default (spawn needs the script guarded by __main__), fork is unsafe on macOS
+    if n_jobs == 1:
+        return [func(t) for t in tasks]
+    if start_method is None and sys.platform.startswith('linux'):
+        start_method = 'fork'
+    with multiprocessing.get_context(start_method).Pool(n_jobs) as pool:
+        return pool.map(func, tasks)
@@ -1,10 +1,46 @@
 # 2020.04.09
 import numpy as np 
-from cwSaab import cwSaab
+from cwSaab import cwSaab, row_slices
+
+def pool_reduce(X, axis, mode='max', dtype='float32'):
+    # 'max', 'avg' or 'absmax' (the value of largest magnitude, sign kept) over 'axis'
+    if mode == 'max':
+        return np.max(X, axis=axis)
+    if mode == 'avg':
+        return np.mean(X, axis=axis, dtype=dtype)
+    assert (mode == 'absmax'), "Pooling mode must be 'max', 'avg' or 'absmax'!"
+    mx, mn = np.max(X, axis=axis), np.min(X, axis=axis)
+    return np.where(-mn > mx, mn, mx)
+
+def pool_hop(X, poolArg):
+    # pooling of a hop output (N, H, W, C) with non-overlapping win x win windows,
+    # borders are padded with 0 like skimage block_reduce, the result is in poolArg 'dtype'
+    win, mode, dtype = poolArg['win'], poolArg.get('mode', 'max'), poolArg.get('dtype', 'float32')
+    N, H, W, C = X.shape
+    H_, W_ = -(-H//win), -(-W//win)
+    if H_ * win != H or W_ * win != W:
+        X = np.pad(X, ((0, 0), (0, H_ * win - H), (0, W_ * win - W), (0, 0)))
+    # reduce the strided views of the window offsets, cheaper than reducing over the windows axes
+    view = [X[:, a::win, b::win] for a in range(win) for b in range(win)]
+    res = np.array(view[0], dtype=dtype)
+    if mode == 'avg':
+        for v in view[1:]:
+            res += v
+        res /= win * win
+        return res
+    for v in view[1:]:
+        np.maximum(res, v, out=res)
+    if mode == 'max':
+        return res
+    assert (mode == 'absmax'), "Pooling mode must be 'max', 'avg' or 'absmax'!"
+    mn = np.array(view[0], dtype=dtype)
+    for v in view[1:]:
+        np.minimum(mn, v, out=mn)
+    return np.where(-mn > res, mn, res)
 
 class Pixelhop2(cwSaab):
-    def __init__(self, depth=1, TH1=0.005, TH2=0.001, SaabArgs=None, shrinkArgs=None, concatArg=None):
-        super().__init__(depth=depth, energyTH=TH1, SaabArgs=SaabArgs, shrinkArgs=shrinkArgs, concatArg={'func':lambda X, concatArg: X})
+    def __init__(self, depth=1, TH1=0.005, TH2=0.001, SaabArgs=None, shrinkArgs=None, concatArg=None, dtype='float32'):
+        super().__init__(depth=depth, energyTH=TH1, SaabArgs=SaabArgs, shrinkArgs=shrinkArgs, concatArg={'func':lambda X, concatArg: X}, dtype=dtype)
         self.TH1 = TH1
         self.TH2 = TH2
         self.idx = []        
@@ -14,22 +50,134 @@ class Pixelhop2(cwSaab):
         #print('select discarded nodes')
         for i in range(self.depth):
             #print('depth {}: shape before = {}'.format(i,X[i].shape))
-            X[i] = X[i][:, :, :, self.Energy[i] >= self.TH2]
+            # the transform plan only computes the columns in keep_, drop the parents kept by TH1 < TH2
+            keep = self.Energy[i] if self.plan[i]['cols'] is None else self.Energy[i][self.plan[i]['cols']]
+            if np.all(keep >= self.TH2) == False:
+                X[i] = X[i][:, :, :, keep >= self.TH2]
             #print('depth {}: shape after = {}'.format(i,X[i].shape))
         return X
 
+    def keep_(self, layer):
+        # nodes below TH2 are discarded by select_ and never computed, parents of the next hop always are
+        keep = self.Energy[layer] >= self.TH2
+        if layer < self.depth - 1:
+            keep |= self.Energy[layer] >= self.TH1
+        return keep
+
     def fit(self, X):
         print('pixelhop2 fit')
+        self.input_shape = X.shape[1:]
         super().fit(X)
         #X = self.select_(X)
         #return self.concatArg['func'](X, self.concatArg)
 
-    def transform(self, X):
+    def poolArgs_(self, pool, mode):
+        pool = pool if isinstance(pool, (list, tuple)) else [pool] * self.depth
+        pool = list(pool) + [None] * (self.depth - len(pool))
+        return [None if win is None else {'func': pool_hop, 'win': win, 'mode': mode, 'dtype': self.dtype} for win in pool]
+
+    def fit_transform(self, X, pool=None, mode='max'):
+        # fit, and return the (pooled) hop outputs computed while fitting, see transform
+        print('pixelhop2 fit')
+        self.input_shape = X.shape[1:]
+        X, _ = super().fit_transform(X, needDC=False, poolArgs=self.poolArgs_(pool, mode))
+        X = self.select_(X)
+        return self.concatArg['func'](X, self.concatArg)
+
+    def transform(self, X, pool=None, mode='max'):
         #print('pixelhop2 transform')
-        X, _ = super().transform(X)
+        # the transform plan already skips every node below TH2 (see keep_)
+        #   pool: pooling window of each hop (int or list), None for no pooling, applied to every batch
+        #         of SaabArgs 'batch' samples as soon as it is computed
+        #   mode: 'max', 'avg' or 'absmax'
+        X, _ = super().transform(X, needDC=False, poolArgs=self.poolArgs_(pool, mode))
         X = self.select_(X)
         return self.concatArg['func'](X, self.concatArg)
 
+    def transform_batch(self, X, batch=100, pool=None, mode='max', index=None, out=None):
+        # per-hop (N, -1) dtype features of any number of samples, transformed 'batch' samples
+        # at a time into outputs allocated once, each hop optionally pooled (see transform)
+        #   index: only transform the samples X[index]
+        #   out: per-hop (len(X), -1) arrays written in place instead, X[index] into the rows index
+        N = X.shape[0] if index is None else len(index)
+        output = out
+        if out is not None:
+            assert (np.all([o.shape[0] == X.shape[0] for o in out])), "out must have a row per sample of X!"
+        for s in row_slices(N, batch):
+            rows = s if index is None else index[s]
+            tmp, _ = super().transform(X[rows], needDC=False, poolArgs=self.poolArgs_(pool, mode))
+            tmp = self.select_(tmp)
+            if output is None:
+                output = [np.empty((N, x[0].size), dtype=self.dtype) for x in tmp]
+            for i in range(self.depth):
+                output[i][s if out is None else rows] = tmp[i].reshape(tmp[i].shape[0], -1)
+        return output
+
+    def compile_selection(self, indexes, pool=2, mode='max'):
+        # compile the feature selection into the model, transform_selected then only computes the
+        # channels and spatial positions feeding the selected features
+        #   indexes[i]: flat indexes into hop i after select_ and pooling, reshaped to (N, -1)
+        #   pool, mode: pooling of each hop, see transform
+        assert (self.trained == True), "Must call fit first!"
+        pool = [None if p is None else p['win'] for p in self.poolArgs_(pool, mode)]
+        self.compile()
+        shape = [x.shape[1:3] for x in super().transform(np.zeros((1,) + self.input_shape, dtype=self.dtype), needDC=False)[0]]
+        leaf, feat = [], []
+        for i in range(self.depth):
+            n_col = len(self.Energy[i])
+            if i >= len(indexes) or len(indexes[i]) == 0:
+                leaf.append(np.zeros(n_col, dtype=bool))
+                feat.append(None)
+                continue
+            p = 1 if pool[i] is None else pool[i]
+            H, W = shape[i]
+            full = np.where(self.Energy[i] >= self.TH2)[0]
+            h, w, c = np.unravel_index(np.asarray(indexes[i]), (-(-H//p), -(-W//p), len(full)))
+            a, b = np.meshgrid(np.arange(p), np.arange(p), indexing='ij')
+            h, w = h.reshape(-1, 1) * p + a.reshape(1, -1), w.reshape(-1, 1) * p + b.reshape(1, -1)
+            valid = (h < H) & (w < W)
+            win = np.where(valid, h * W + w, 0)
+            leaf.append(np.zeros(n_col, dtype=bool))
+            leaf[i][full[c]] = True
+            rows = np.unique(win[valid])
+            # gathering most of the positions costs more than computing all of them
+            feat.append({'col': full[c], 'win': win, 'valid': valid, 'rows': rows if len(rows) <= H * W // 2 else None})
+        # columns needed at every position: parents of the Saabs used by the next hop
+        parent = [np.zeros(len(self.Energy[i]), dtype=bool) for i in range(self.depth)]
+        for i in range(self.depth-1, 0, -1):
+            idx, _ = self.input_(i, {'cols': None})
+            K = len(self.Energy[i]) // len(idx)
+            need = np.any((leaf[i] | parent[i]).reshape(-1, K), axis=1)
+            parent[i-1][idx[need]] = True
+        last = max([i for i in range(self.depth) if np.any(leaf[i])], default=-1)
+        plan = []
+        for i in range(last+1):
+            rows = None if feat[i] is None else feat[i]['rows']
+            plan.append(self.compile_layer(i, prev=plan[i-1] if i > 0 else None, keep=leaf[i] | parent[i],
+                                           sparse=None if rows is None else leaf[i] & ~parent[i], rows=rows))
+            if feat[i] is not None:
+                feat[i]['pos'] = np.searchsorted(plan[i]['cols'], feat[i]['col']) if plan[i]['cols'] is not None else feat[i]['col']
+        self.selection = {'plan': plan, 'feat': feat, 'mode': mode}
+
+    def transform_selected(self, X, batch=None):
+        # selected features of every hop, (N, len(indexes[i])) in the order of indexes[i], same as
+        # pooling the output of transform, flattening it and taking indexes[i]
+        assert (hasattr(self, 'selection')), "Must call compile_selection first!"
+        plan, feat = self.selection['plan'], self.selection['feat']
+        output = [np.empty((X.shape[0], 0 if f is None else len(f['col'])), dtype=self.dtype) for f in feat]
+        for s in row_slices(X.shape[0], X.shape[0] if batch is None else batch):
+            tmp = X[s]
+            for i in range(len(plan)):
+                tmp, _ = self.SaabTransform(tmp, i, needDC=False, plan=plan[i])
+                if feat[i] is not None:
+                    res = tmp.reshape(tmp.shape[0], -1, tmp.shape[-1])[:, feat[i]['win'], feat[i]['pos'].reshape(-1, 1)]
+                    # padding of block_reduce is 0
+                    res[:, ~feat[i]['valid']] = 0
+                    output[i][s] = pool_reduce(res, 2, self.selection['mode'], self.dtype)
+                    if plan[i].get('quant') is not None and plan[i]['quant']['Out'] is not None:
+                        output[i][s] *= plan[i]['quant']['Out'][feat[i]['pos']]
+        return output[:len(feat)]
+
 if __name__ == "__main__":
     # example useage
     from sklearn import datasets
@@ -69,4 +217,54 @@ if __name__ == "__main__":
     p2.fit(X)
     output = p2.transform(X)
     print(output[0].shape, output[1].shape)
+    from skimage.measure import block_reduce
+    print(" -----> fit_transform")
+    p3 = Pixelhop2(depth=2, TH1=0.005, TH2=0.001, SaabArgs=SaabArgs, shrinkArgs=shrinkArgs, concatArg=concatArg)
+    fitted = p3.fit_transform(X, pool=2)
+    for i in range(2):
+        assert (np.allclose(fitted[i], p3.transform(X, pool=2)[i], atol=1e-5)), "fit_transform differs from transform!"
+    print(" -----> transform_batch")
+    batched = p2.transform_batch(X, batch=500, pool=2)
+    for i in range(2):
+        assert (np.allclose(batched[i], block_reduce(output[i], (1, 2, 2, 1), np.max).reshape(len(X), -1), atol=1e-5)), "transform_batch differs from transform!"
+    index = np.arange(0, len(X), 3)
+    for i, x in enumerate(p2.transform_batch(X, batch=100, pool=2, index=index)):
+        assert (np.allclose(x, batched[i][index])), "transform_batch differs on X[index]!"
+    out = [np.zeros_like(b) for b in batched]
+    p2.transform_batch(X, batch=100, pool=2, index=index, out=out)
+    for i in range(2):
+        assert (np.allclose(out[i][index], batched[i][index]) and not np.any(np.delete(out[i], index, axis=0))), "transform_batch out error!"
+    print(" -----> dtype='float64'")
+    p4 = Pixelhop2(depth=2, TH1=0.005, TH2=0.001, SaabArgs=SaabArgs, shrinkArgs=shrinkArgs, concatArg=concatArg, dtype='float64')
+    p4.fit(X)
+    for i, x in enumerate(p4.transform_batch(X, batch=500, pool=2)):
+        assert (x.dtype == 'float64' and np.allclose(x, batched[i], atol=1e-4)), "float64 transform_batch error!"
+    print(" -----> pooled transform")
+    for mode, func in [('max', np.max), ('avg', np.mean)]:
+        pooled = p2.transform(X, pool=[2, 1], mode=mode)
+        for i, win in enumerate([2, 1]):
+            assert (np.allclose(pooled[i], block_reduce(output[i], (1, win, win, 1), func), atol=1e-5)), "pooled transform differs from transform!"
+    print(" -----> compile_selection")
+    for mode in ['max', 'avg', 'absmax']:
+        pooled = p2.transform(X, pool=2, mode=mode)
+        for indexes in [[np.random.RandomState(0).permutation(o[0].size)[:20] for o in pooled],
+                        [np.arange(o.shape[-1])[::-1] for o in pooled]]:
+            p2.compile_selection(indexes, pool=2, mode=mode)
+            selected = p2.transform_selected(X, batch=500)
+            for i in range(2):
+                ref = pooled[i].reshape(len(X), -1)[:, indexes[i]]
+                assert (np.allclose(selected[i], ref, atol=1e-4)), "transform_selected differs from transform!"
+    print(" -----> quantize")
+    X8 = X.astype('uint8')
+    reference = p2.transform(X8 / 16, pool=2)
+    for dtype in ['int8', 'float16']:
+        report = p2.quantize(X8, dtype=dtype, scale=1/16)
+        assert (np.all([r['error'] < 0.02 for r in report])), "%s quantization error!"%dtype
+        quantized = p2.transform(X8, pool=2)
+        for i in range(2):
+            assert (np.linalg.norm(quantized[i] - reference[i]) < 0.02 * np.linalg.norm(reference[i])), "%s transform error!"%dtype
+        p2.compile_selection(indexes, pool=2)
+        selected = p2.transform_selected(X8, batch=500)
+        for i in range(2):
+            assert (np.allclose(selected[i], quantized[i].reshape(len(X), -1)[:, indexes[i]], atol=1e-4)), "%s transform_selected error!"%dtype
     print("------- DONE -------\n")
@@ -5,10 +5,33 @@
 
 import numpy as np
 from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.utils.extmath import randomized_svd
+from sklearn.utils import gen_batches
 import time
 
+def saab_eig(cov, num_kernels, solver='eigh'):
+    # PCA of the DC removed patches from their (..., D, D) covariances
+    D = cov.shape[-1]
+    P = np.eye(D) - 1 / D
+    cov = np.matmul(np.matmul(P, cov), P)
+    if solver == 'eigh':
+        var, kernels = np.linalg.eigh(cov)
+        var = var[..., ::-1][..., :num_kernels]
+        kernels = np.swapaxes(kernels[..., ::-1][..., :num_kernels], -1, -2)
+    else:
+        kernels, var = [], []
+        for c in cov.reshape(-1, D, D):
+            tmp, tmp_var, _ = randomized_svd(c, n_components=num_kernels, random_state=0)
+            kernels.append(np.transpose(tmp))
+            var.append(tmp_var)
+        kernels = np.array(kernels).reshape(cov.shape[:-2] + (num_kernels, D))
+        var = np.array(var).reshape(cov.shape[:-2] + (num_kernels,))
+    # same sign convention as sklearn PCA (svd_flip)
+    sign = np.sign(np.take_along_axis(kernels, np.argmax(np.abs(kernels), axis=-1)[..., None], axis=-1))
+    return kernels * sign, np.maximum(var, 0)
+
 class Saab():
-    def __init__(self, num_kernels=-1, useDC=True, needBias=True):
+    def __init__(self, num_kernels=-1, useDC=True, needBias=True, solver='pca'):
         self.par = None
         self.Kernels = []
         self.Bias = []
@@ -17,45 +40,167 @@ class Saab():
         self.num_kernels = num_kernels
         self.useDC = useDC
         self.needBias = needBias
+        assert (solver in ['pca', 'eigh', 'randomized']), "'solver' must be 'pca', 'eigh' or 'randomized'!"
+        self.solver = solver
         self.trained = False
+        self.num = 0
+        self.pca = None
+        self.Separable = None
+        self.Quant = None
 
     def remove_mean(self, X, axis):
         feature_mean = np.mean(X, axis=axis, keepdims=True)
         X = X - feature_mean
         return X, feature_mean
 
-    def fit(self, X): 
-        assert (len(X.shape) == 2), "Input must be a 2D array!"
-        X = X.astype('float32')
-        X, self.Mean0 = self.remove_mean(X.copy(), axis=0)
-        X, dc = self.remove_mean(X.copy(), axis=1)
-        self.Bias = np.max(np.linalg.norm(X, axis=1)) * 1 / np.sqrt(X.shape[1])
+    def init_(self, shift):
         if self.num_kernels == -1:
-            self.num_kernels = X.shape[-1]
-        # pca = PCA(n_components=self.num_kernels, svd_solver='full').fit(X)
-        pca = IncrementalPCA(n_components=self.num_kernels).fit(X)
-        kernels = pca.components_
-        energy = pca.explained_variance_ / np.sum(pca.explained_variance_)
+            self.num_kernels = shift.shape[-1]
+        if self.solver == 'pca':
+            self.pca = IncrementalPCA(n_components=self.num_kernels)
+        # statistics are kept around the first chunk's mean to avoid cancellation
+        self.shift = shift
+        self.sum0 = np.zeros((1, shift.shape[-1]))
+        self.sum2 = np.zeros((shift.shape[-1], shift.shape[-1]))
+        self.dc_sum, self.dc_sum2 = 0., 0.
+
+    def partial_fit(self, X):
+        # pass 1 over patch chunks: accumulate Mean0, DC energy and PCA
+        assert (len(X.shape) == 2), "Input must be a 2D array!"
+        if self.num == 0:
+            self.init_(np.mean(X, axis=0, keepdims=True, dtype='float32'))
+        if self.solver == 'pca':
+            assert (X.shape[0] >= self.num_kernels), "Each chunk needs at least 'num_kernels' samples!"
+            # fed to IncrementalPCA by its own fit batch size 5 * D, a whole chunk at once holds its
+            # centred copy and its SVD workspace
+            for s in gen_batches(X.shape[0], 5 * X.shape[1], min_batch_size=self.num_kernels):
+                self.partial_fit_pca_(X[s])
+            return
+        X = np.subtract(X, self.shift, dtype='float32')
+        self.num += X.shape[0]
+        self.sum0 += np.sum(X, axis=0, keepdims=True, dtype='float64')
+        self.sum2 += np.matmul(np.transpose(X), X)
+
+    def partial_fit_pca_(self, X):
+        X = np.subtract(X, self.shift, dtype='float32')
+        self.num += X.shape[0]
+        self.sum0 += np.sum(X, axis=0, keepdims=True, dtype='float64')
+        X, dc = self.remove_mean(X, axis=1)
+        self.dc_sum += np.sum(dc, dtype='float64')
+        self.dc_sum2 += np.sum(np.square(dc, dtype='float64'))
+        # PCA is shift invariant, removing Mean0 is left to IncrementalPCA
+        self.pca.partial_fit(X)
+
+    def partial_fit_stats(self, num, sum0, sum2, shift):
+        # pass 1 from the sums over 'num' patches minus 'shift' (1, D) gathered elsewhere, see cwSaab.patch_stats
+        assert (self.solver != 'pca'), "Fitting from patch statistics needs solver 'eigh' or 'randomized'!"
+        if self.num == 0:
+            self.init_(shift)
+        assert (np.all(shift == self.shift)), "Statistics must be taken around the same shift!"
+        self.num += num
+        self.sum0 += sum0
+        self.sum2 += sum2
+
+    def cov_(self):
+        mean = self.sum0 / self.num
+        return mean, (self.sum2 - self.num * np.matmul(np.transpose(mean), mean)) / (self.num - 1)
+
+    def end_fit(self, eig=None):
+        # 'eig': (kernels, var) of cov_() when already decomposed, see end_fit_stacked
+        assert (self.num > 0), "Must call partial_fit first!"
+        D = self.sum0.shape[-1]
+        mean, cov = self.cov_()
+        self.Mean0 = (self.shift + mean).astype('float32')
+        if self.solver == 'pca':
+            kernels, var = self.pca.components_, self.pca.explained_variance_
+            largest_ev = D * (self.dc_sum2 / self.num - (self.dc_sum / self.num) ** 2)
+        else:
+            kernels, var = saab_eig(cov, self.num_kernels, self.solver) if eig is None else eig
+            # variance of the patch mean, scaled by D
+            largest_ev = np.sum(cov) / D * (self.num - 1) / self.num
+        energy = var / np.sum(var)
         if self.useDC == True:  
-            largest_ev = np.var(dc * np.sqrt(X.shape[-1]))     
-            dc_kernel = 1 / np.sqrt(X.shape[-1]) * np.ones((1, X.shape[-1])) / np.sqrt(largest_ev)
+            dc_kernel = 1 / np.sqrt(D) * np.ones((1, D)) / np.sqrt(largest_ev)
             kernels = np.concatenate((dc_kernel, kernels[:-1]), axis=0)
-            energy = np.concatenate((np.array([largest_ev]), pca.explained_variance_[:-1]), axis=0)
+            energy = np.concatenate((np.array([largest_ev]), var[:-1]), axis=0)
             energy = energy / np.sum(energy)
         self.Kernels, self.Energy = kernels, energy
+        self.Bias = 0
+        self.pca, self.sum2 = None, None
         self.trained = True
+        self.fold_()
+
+    def partial_bias(self, X):
+        # pass 2 over patch chunks: Bias depends on the final Mean0
+        assert (self.trained == True), "Must call end_fit first!"
+        X = np.subtract(X, self.Mean0, dtype='float32')
+        X, _ = self.remove_mean(X, axis=1)
+        self.update_bias(np.max(np.linalg.norm(X, axis=1)) * 1 / np.sqrt(X.shape[1]))
+
+    def update_bias(self, bias):
+        if bias > self.Bias:
+            self.Bias = bias
+            self.fold_()
+
+    def fit(self, X): 
+        self.num = 0
+        self.partial_fit(X)
+        self.end_fit()
+        self.partial_bias(X)
         
-    def transform(self, X):
+    def compress(self, win, tol=0.05, max_rank=None):
+        # separable approximation of the kernels for inference, each kernel reshaped to (win, win * C)
+        # is cut by SVD into the fewest products of a column filter (win,) and a row filter (win * C,)
+        # within relative error 'tol' (at most 'max_rank' of them); transform then uses the approximation
         assert (self.trained == True), "Must call fit first!"
-        X = X.astype('float32')
-        X -= self.Mean0
-        if self.needBias == True:
-            X += self.Bias
-        dc = np.mean(X.copy(), axis=1, keepdims=True)
-        X = np.matmul(X, np.transpose(self.Kernels))
+        K, D = self.Kernels.shape
+        u, sv, vt = np.linalg.svd(self.Kernels.reshape(K, win, D // win), full_matrices=False)
+        error = np.sqrt(np.maximum(1 - np.cumsum(np.square(sv), axis=1) / np.sum(np.square(sv), axis=1, keepdims=True), 0))
+        rank = np.argmax(error <= tol, axis=1) + 1
+        if max_rank is not None:
+            rank = np.minimum(rank, max_rank)
+        R = np.max(rank)
+        # terms past the rank of a kernel are zeroed
+        col = np.swapaxes(u[:, :, :R] * (sv[:, :R] * (np.arange(R) < rank.reshape(-1, 1))).reshape(K, 1, R), 1, 2)
+        kernels = np.matmul(np.swapaxes(col, 1, 2), vt[:, :R]).reshape(K, D)
+        self.Separable = {'win': win, 'Col': col.astype('float32'), 'Row': vt[:, :R].astype('float32'),
+                          'Kernels': kernels, 'rank': rank, 'error': np.linalg.norm(kernels - self.Kernels, axis=1) / np.linalg.norm(self.Kernels, axis=1)}
+        self.fold_()
+
+    def quantize(self, dtype='int8'):
+        # kernels for quantized inference: int8 with one scale per kernel, Weight ~ Quant['Weight'] * Quant['Scale'],
+        # or float16 (scale 1)
+        assert (self.trained == True), "Must call fit first!"
+        assert (dtype in ['int8', 'float16']), "'dtype' must be 'int8' or 'float16'!"
+        if dtype == 'float16':
+            self.Quant = {'dtype': dtype, 'Weight': self.Weight.astype('float16'), 'Scale': np.ones((1, self.Weight.shape[1]), dtype='float32')}
+            return
+        scale = np.max(np.abs(self.Weight), axis=0, keepdims=True) / 127
+        scale[scale == 0] = 1
+        self.Quant = {'dtype': dtype, 'Weight': np.rint(self.Weight / scale).astype('int8'), 'Scale': scale.astype('float32')}
+
+    def fold_(self):
+        # transform is affine: (X - Mean0 + Bias) @ Kernels.T, minus Bias on the DC kernel
+        bias = self.Bias if self.needBias == True else 0
+        kernels = self.Kernels if self.Separable is None else self.Separable['Kernels']
+        self.Weight = np.ascontiguousarray(np.transpose(kernels)).astype('float32')
+        self.Offset = np.matmul(bias - self.Mean0, np.transpose(kernels)).astype('float32')
         if self.needBias == True and self.useDC == True:
-            X[:, 0] -= self.Bias
-        return X, dc
+            self.Offset[:, 0] -= bias
+        self.Offset_dc = np.float32(bias - np.mean(self.Mean0))
+
+    def transform(self, X, out=None, needDC=True):
+        # single GEMM with the folded kernels, written into 'out' if given
+        assert (self.trained == True), "Must call fit first!"
+        X = X.astype('float32', copy=False)
+        if out is None:
+            out = np.empty((X.shape[0], self.Weight.shape[1]), dtype='float32')
+        np.matmul(X, self.Weight, out=out)
+        out += self.Offset
+        dc = None
+        if needDC == True:
+            dc = np.mean(X, axis=1, keepdims=True, dtype='float32') + self.Offset_dc
+        return out, dc
     
     def inverse_transform(self, X, DC):
         assert (self.trained == True), "Must call fit first!"
@@ -71,12 +216,82 @@ class Saab():
         X += self.Mean0
         return X
 
+class StackedSaab():
+    # one Saab per channel fitted together, X is (C, N, D) holding the patches of all C channels
+    def __init__(self, saabs):
+        assert (saabs[0].solver != 'pca'), "Stacked fitting needs solver 'eigh' or 'randomized'!"
+        self.saabs = saabs
+        self.num = 0
+
+    def partial_fit(self, X):
+        assert (len(X.shape) == 3 and X.shape[0] == len(self.saabs)), "Input must be a (C, N, D) array!"
+        if self.num == 0:
+            self.shift = np.mean(X, axis=1, keepdims=True, dtype='float32')
+            self.sum0 = np.zeros((X.shape[0], 1, X.shape[2]))
+            self.sum2 = np.zeros((X.shape[0], X.shape[2], X.shape[2]))
+        X = np.subtract(X, self.shift, dtype='float32')
+        self.num += X.shape[1]
+        self.sum0 += np.sum(X, axis=1, keepdims=True, dtype='float64')
+        self.sum2 += np.matmul(np.swapaxes(X, 1, 2), X)
+
+    def partial_fit_stats(self, num, sum0, sum2, shift):
+        # stacked Saab.partial_fit_stats: sum0 (C, 1, D), sum2 (C, D, D), shift (C, 1, D)
+        if self.num == 0:
+            self.shift = shift.astype('float32')
+            self.sum0 = np.zeros(sum0.shape)
+            self.sum2 = np.zeros(sum2.shape)
+        self.num += num
+        self.sum0 += sum0
+        self.sum2 += sum2
+
+    def end_fit(self):
+        for c, saab in enumerate(self.saabs):
+            saab.init_(self.shift[c])
+            saab.num, saab.sum0, saab.sum2 = self.num, self.sum0[c], self.sum2[c]
+        cov = np.array([saab.cov_()[1] for saab in self.saabs])
+        kernels, var = saab_eig(cov, self.saabs[0].num_kernels, self.saabs[0].solver)
+        for c, saab in enumerate(self.saabs):
+            saab.end_fit(eig=(kernels[c], var[c]))
+        self.Mean0 = np.array([saab.Mean0 for saab in self.saabs])
+        self.Bias = np.zeros(len(self.saabs))
+
+    def partial_bias(self, X):
+        X = np.subtract(X, self.Mean0, dtype='float32')
+        # squared norm of the DC removed patch: |x|^2 - D * mean(x)^2
+        norm = np.einsum('cnd,cnd->cn', X, X) - np.square(np.sum(X, axis=2)) / X.shape[2]
+        self.update_bias(np.sqrt(np.max(np.maximum(norm, 0), axis=1)) * 1 / np.sqrt(X.shape[2]))
+
+    def update_bias(self, bias):
+        for c in np.where(bias > self.Bias)[0]:
+            self.saabs[c].update_bias(bias[c])
+        self.Bias = np.maximum(self.Bias, bias)
+
 if __name__ == "__main__":
     from sklearn import datasets
     print(" > This is a test example: ")
     digits = datasets.load_digits()
     data = digits.images.reshape((len(digits.images), 8, 8, 1))
     print(" input feature shape: %s"%str(data.shape))
+
+    print(" --> test solvers")
+    X = data.copy()
+    X = X.reshape(X.shape[0], -1)
+    ref = Saab(num_kernels=-1, useDC=True, needBias=True, solver='pca')
+    ref.fit(X)
+    for solver in ['eigh', 'randomized']:
+        saab = Saab(num_kernels=-1, useDC=True, needBias=True, solver=solver)
+        saab.fit(X)
+        # directions of zero energy (constant pixels) are not unique
+        keep = ref.Energy > 1e-8
+        assert (np.max(np.abs(saab.transform(X)[0] - ref.transform(X)[0])[:, keep]) < 1e-2), "%s solver error!"%solver
+    print(" -----> fit time on CIFAR shaped patches (100 images, 28x28, win=5, 3 channels)")
+    X = np.random.RandomState(0).rand(100 * 28 * 28, 75).astype('float32')
+    for num_kernels in [-1, 10]:
+        for solver in ['pca', 'eigh', 'randomized']:
+            saab = Saab(num_kernels=num_kernels, useDC=True, needBias=True, solver=solver)
+            t0 = time.time()
+            saab.fit(X)
+            print("        num_kernels=%3d, solver=%-10s: %.3fs"%(num_kernels, solver, time.time() - t0))
     
     print(" --> test inv")
     print(" -----> num_kernels=-1, needBias=False, useDC=True")